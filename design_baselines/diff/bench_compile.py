@@ -0,0 +1,73 @@
+"""
+Compare eager and compiled sampler steps/sec for the drift MLP at several hidden sizes.
+
+    python design_baselines/diff/bench_compile.py --hidden_sizes 256 1024 4096 --backend auto
+"""
+
+import argparse
+import time
+
+import torch
+
+from nets import MLP
+from lib.sdes import VariancePreservingSDE, PluginReverseSDE
+from lib.samplers import grid_schedule, build_compiled_step
+
+
+@torch.no_grad()
+def steps_per_sec(gen_sde, x_0, ya, num_steps, predictor, backend, gamma, repeats):
+    # the step is traced / compiled once, like in compiled_sampler, and only the step loop is timed
+    schedule = grid_schedule(gen_sde, num_steps)
+    step = build_compiled_step(gen_sde, schedule, x_0, ya, gamma=gamma, predictor=predictor, backend=backend)
+    steps = torch.arange(num_steps + 1, device=x_0.device).view(-1, 1)
+    mu_0 = gen_sde.mu_at(schedule, 0, x_0, ya, gamma=gamma)
+
+    def run():
+        x_t, mu = x_0, mu_0
+        for i in range(num_steps):
+            z = torch.randn_like(x_t)
+            if predictor == 'euler':
+                x_t = step(x_t, ya, steps[i], z)
+            else:
+                x_t, mu = step(x_t, mu, ya, steps[i], z)
+
+    # the first run includes the lazy compilation of torch.compile and the jit optimisation passes and is not timed
+    run()
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return num_steps / best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hidden_sizes', type=int, nargs='+', default=[256, 512, 1024, 2048, 4096])
+    parser.add_argument('--dim', type=int, default=56, help='design dimension (56 is dkitty)')
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--num_steps', type=int, default=100)
+    parser.add_argument('--predictor', type=str, choices=['euler', 'heun'], default='euler')
+    parser.add_argument('--backend', type=str, choices=['auto', 'jit', 'compile'], default='auto')
+    parser.add_argument('--gamma', type=float, default=2.)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    print(f"{'hidden':>8} {'eager steps/s':>14} {args.backend + ' steps/s':>14} {'speedup':>8}")
+    for hidden_size in args.hidden_sizes:
+        drift_q = MLP(input_dim=args.dim, index_dim=1, hidden_dim=hidden_size)
+        T = torch.nn.Parameter(torch.FloatTensor([1.]), requires_grad=False)
+        inf_sde = VariancePreservingSDE(beta_min=0.01, beta_max=2.0, T=T)
+        gen_sde = PluginReverseSDE(inf_sde, drift_q, T).eval()
+
+        x_0 = torch.randn(args.batch_size, args.dim)
+        ya = torch.ones(args.batch_size)
+        eager = steps_per_sec(gen_sde, x_0, ya, args.num_steps, args.predictor, 'none', args.gamma, args.repeats)
+        compiled = steps_per_sec(gen_sde, x_0, ya, args.num_steps, args.predictor, args.backend, args.gamma,
+                                 args.repeats)
+        print(f"{hidden_size:>8} {eager:>14.1f} {compiled:>14.1f} {compiled / eager:>7.2f}x")
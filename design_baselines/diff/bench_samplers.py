@@ -0,0 +1,308 @@
+"""
+Benchmark samplers of a trained DDOM checkpoint: wall-clock, NFE, peak memory, designs/sec and the 50th/90th/100th
+percentile of the oracle scores, normalised with the min/max of the task's dataset, for every sampler and step count.
+Every run draws its prior and noise from the same NoiseBank, so differences come from the samplers only.
+
+Samplers are given as name[:key=value,...], e.g. heun, ddim:eta=1.0, dpm_solver:order=3, ode:rtol=1e-4,atol=1e-4
+(ode is adaptive and ignores the step counts). With --denoise_t_stops, every fixed grid sampler is also run
+stopped at each of these times with a final Tweedie denoising step, and the steps it saves to reach the score of
+the plain sampler are written to <out>_denoise.csv. The Branin stand-in task runs on CPU without design-bench:
+
+    python design_baselines/diff/bench_samplers.py --task branin \
+        --checkpoint design_baselines/diff_branin/experiments/branin/<name>/<seed>/wandb/latest-run/files/checkpoints/last.ckpt \
+        --samplers euler_maruyama heun ddim dpm_solver:order=2 --num_steps 10 25 50 100 --out bench.csv
+"""
+
+import argparse
+import ast
+import csv
+import importlib.util
+import inspect
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+
+from nets import MLP
+from lib.sdes import VariancePreservingSDE, PluginReverseSDE, ScorePluginReverseSDE
+from lib.samplers import (heun_sampler, euler_maruyama_sampler, pc_sampler, ode_sampler, dpm_solver_sampler,
+                          ddim_sampler, picard_sampler, NoiseBank)
+from util import TASKNAME2TASK
+
+SAMPLERS = dict(heun=heun_sampler,
+                euler_maruyama=euler_maruyama_sampler,
+                pc=pc_sampler,
+                ode=ode_sampler,
+                dpm_solver=dpm_solver_sampler,
+                ddim=ddim_sampler,
+                picard=picard_sampler)
+
+
+def load_branin_task(path):
+    """
+    the Branin stand-in task of diff_branin/branin_task.py, loaded from its file since diff_branin is a script
+    directory (with its own lib and nets modules) rather than a package
+    """
+    module_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'diff_branin', 'branin_task.py')
+    spec = importlib.util.spec_from_file_location('branin_task', module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Branin(path)
+
+
+def make_task(args):
+    if args.task == 'branin':
+        task = load_branin_task(args.branin_path)
+    else:
+        import design_bench
+        task = design_bench.make(TASKNAME2TASK[args.task])
+    if args.normalise_x:
+        task.map_normalize_x()
+    if args.normalise_y:
+        task.map_normalize_y()
+    if task.is_discrete:
+        task.map_to_logits()
+    return task
+
+
+def load_gen_sde(checkpoint_path, dim, args, device=None):
+    """
+    reverse SDE of a DiffusionTest (or, with --score_matching, DiffusionScore) Lightning checkpoint, rebuilt from
+    its state dict so that neither the task nor Lightning is needed to load it
+    """
+    state_dict = torch.load(checkpoint_path, map_location='cpu')['state_dict']
+    prefix = 'score_estimator.' if args.score_matching else 'drift_q.'
+    net = MLP(input_dim=dim, index_dim=1, hidden_dim=args.hidden_size)
+    net.load_state_dict({k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)})
+    T = torch.nn.Parameter(torch.FloatTensor([args.T0]), requires_grad=False)
+    inf_sde = VariancePreservingSDE(beta_min=args.beta_min, beta_max=args.beta_max, T=T)
+    reverse_sde = ScorePluginReverseSDE if args.score_matching else PluginReverseSDE
+    return reverse_sde(inf_sde, net, T).to(device).eval()
+
+
+def parse_sampler(spec):
+    """
+    'name:key=value,...' -> (name, kwargs), values are parsed as python literals when possible
+    and kept as strings otherwise (grid=edm)
+    """
+    name, _, options = spec.partition(':')
+    assert name in SAMPLERS, f"unknown sampler {name}, choose from {sorted(SAMPLERS)}"
+    kwargs = {}
+    for option in filter(None, options.split(',')):
+        key, value = option.split('=')
+        try:
+            kwargs[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            kwargs[key] = value
+    return name, kwargs
+
+
+class PeakMemory(object):
+    """
+    peak memory of a code block in MB: allocated CUDA memory on a GPU, otherwise the increase of the resident set
+    size of the process, polled every millisecond
+    """
+    def __init__(self, device):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.peak = 0.
+
+    @staticmethod
+    def _rss():
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def _poll(self):
+        while not self.done.is_set():
+            self.peak_rss = max(self.peak_rss, self._rss())
+            time.sleep(1e-3)
+
+    def __enter__(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self.base = torch.cuda.memory_allocated()
+        else:
+            self.base = self.peak_rss = self._rss()
+            self.done = threading.Event()
+            self.thread = threading.Thread(target=self._poll, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.cuda:
+            torch.cuda.synchronize()
+            self.peak = (torch.cuda.max_memory_allocated() - self.base) / 2**20
+        else:
+            self.done.set()
+            self.thread.join()
+            self.peak = (max(self.peak_rss, self._rss()) - self.base) / 2**20
+
+
+@torch.no_grad()
+def run_sampler(name, kwargs, gen_sde, num_samples, dim, condition, num_steps, gamma=0., seed=0):
+    """
+    draw num_samples designs with one sampler; returns the final designs, NFE, sequential NFE (fewer than the NFE
+    only for samplers evaluating several steps at once), wall-clock seconds and peak memory
+    """
+    device = gen_sde.T.device
+    bank = NoiseBank(seed, torch.arange(num_samples), device=device)
+    x_0 = bank.prior(dim)
+    ya = torch.ones(num_samples, device=device) * condition
+    sampler = SAMPLERS[name]
+    kwargs = dict(kwargs)
+    if 'noise' in inspect.signature(sampler).parameters:
+        kwargs['noise'] = bank
+    stats = {}
+    if 'stats' in inspect.signature(sampler).parameters:
+        kwargs['stats'] = stats
+    with PeakMemory(device) as memory:
+        start = time.perf_counter()
+        if name == 'ode':
+            xs, nfe = sampler(gen_sde, x_0, ya, gamma=gamma, keep_all_samples=False, **kwargs)
+        else:
+            xs, nfe = sampler(gen_sde, x_0, ya, num_steps, gamma=gamma, keep_all_samples=False, **kwargs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        wall = time.perf_counter() - start
+    return xs[-1], nfe, stats.get('sequential_nfe', nfe), wall, memory.peak
+
+
+def score(task, x, y_min, y_max, normalise_y=False):
+    """
+    oracle scores of the finite designs, normalised to the dataset's [y_min, y_max]
+    """
+    x = x[torch.isfinite(x).all(dim=1)].numpy()
+    if task.is_discrete:
+        x = x.reshape(x.shape[0], -1, task.x.shape[-1])
+    ys = task.predict(x).reshape(-1)
+    if normalise_y:
+        ys = task.denormalize_y(ys).reshape(-1)
+    return (ys - y_min) / (y_max - y_min)
+
+
+def steps_to_match(rows, spec, target, metric='p90'):
+    """
+    fewest steps at which sampler spec reaches target on metric, None if it never does
+    """
+    steps = [row['num_steps'] for row in rows if row['sampler'] == spec and row[metric] >= target]
+    return min(steps) if steps else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', type=str, choices=['branin'] + list(TASKNAME2TASK.keys()), default='branin')
+    parser.add_argument('--checkpoint', type=str, required=True, help='Lightning checkpoint of a trained model')
+    parser.add_argument('--branin_path', type=str, default='design_baselines/diff_branin/dataset/branin_unif_5000.p')
+    parser.add_argument('--samplers', type=str, nargs='+', default=['euler_maruyama', 'heun', 'ddim', 'dpm_solver'])
+    parser.add_argument('--num_steps', type=int, nargs='+', default=[10, 25, 50, 100, 250, 1000])
+    parser.add_argument('--num_samples', type=int, default=512)
+    parser.add_argument('--condition', type=float, default=None, help='default: the dataset max')
+    parser.add_argument('--gamma', type=float, default=0.)
+    parser.add_argument('--seed', type=int, default=0, help='noise bank seed shared by every run')
+    parser.add_argument('--hidden_size', type=int, default=1024)
+    parser.add_argument('--beta_min', type=float, default=0.1)
+    parser.add_argument('--beta_max', type=float, default=20.0)
+    parser.add_argument('--T0', type=float, default=1.0)
+    parser.add_argument('--score_matching', action='store_true', default=False)
+    parser.add_argument('--normalise_x', action='store_true', default=False)
+    parser.add_argument('--normalise_y', action='store_true', default=False)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--denoise_t_stops',
+                        type=float,
+                        nargs='*',
+                        default=[],
+                        help='also run every fixed grid sampler stopped at these times with a final Tweedie '
+                        'denoising step, and report how many steps it saves for the same score')
+    parser.add_argument('--match_metric', type=str, choices=['p50', 'p90', 'p100'], default='p90')
+    parser.add_argument('--match_tol',
+                        type=float,
+                        default=0.01,
+                        help='a run matches a reference score if it is at most match_tol below it')
+    parser.add_argument('--out', type=str, default='bench_samplers.csv')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    task = make_task(args)
+    dim = int(np.prod(task.x.shape[1:]))
+    gen_sde = load_gen_sde(args.checkpoint, dim, args, device)
+    condition = float(task.y.max()) if args.condition is None else args.condition
+    ys = task.y.reshape(-1)
+    if args.normalise_y:
+        ys = task.denormalize_y(ys).reshape(-1)
+    y_min, y_max = float(ys.min()), float(ys.max())
+
+    # warm up the kernels and the allocator so that the first run is not penalised
+    run_sampler('euler_maruyama', {}, gen_sde, min(args.num_samples, 64), dim, condition, 2, gamma=args.gamma)
+
+    # Tweedie variants of the fixed grid samplers, and the plain sampler they are compared with
+    specs, base_spec = list(args.samplers), {}
+    for spec in args.samplers:
+        if parse_sampler(spec)[0] == 'ode':
+            continue
+        for t_stop in args.denoise_t_stops:
+            variant = spec + (',' if ':' in spec else ':') + f"t_stop={t_stop},denoise=True"
+            specs.append(variant)
+            base_spec[variant] = spec
+
+    rows = []
+    for spec in specs:
+        name, kwargs = parse_sampler(spec)
+        for num_steps in ([None] if name == 'ode' else args.num_steps):
+            x, nfe, sequential_nfe, wall, peak = run_sampler(name,
+                                                             kwargs,
+                                                             gen_sde,
+                                                             args.num_samples,
+                                                             dim,
+                                                             condition,
+                                                             num_steps,
+                                                             gamma=args.gamma,
+                                                             seed=args.seed)
+            scores = score(task, x, y_min, y_max, normalise_y=args.normalise_y)
+            rows.append(dict(sampler=spec,
+                             num_steps=num_steps,
+                             nfe=nfe,
+                             sequential_nfe=sequential_nfe,
+                             wall_s=wall,
+                             peak_mem_mb=peak,
+                             designs_per_s=args.num_samples / wall,
+                             failure_rate=1. - len(scores) / args.num_samples,
+                             p50=np.percentile(scores, 50) if len(scores) else np.nan,
+                             p90=np.percentile(scores, 90) if len(scores) else np.nan,
+                             p100=scores.max() if len(scores) else np.nan))
+            print("{sampler:>24} steps={num_steps} NFE={nfe} ({sequential_nfe} sequential) {wall_s:.3f}s {peak_mem_mb:.1f}MB "
+                  "{designs_per_s:.1f} designs/s p50={p50:.4f} p90={p90:.4f} p100={p100:.4f}".format(**rows[-1]))
+
+    with open(args.out, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"wrote {args.out}")
+
+    if base_spec:
+        # steps saved by the Tweedie variants for the score of the plain sampler at its largest step count
+        matches = []
+        for variant, spec in base_spec.items():
+            reference = max((row for row in rows if row['sampler'] == spec), key=lambda row: row['num_steps'])
+            target = reference[args.match_metric] - args.match_tol
+            plain_steps = steps_to_match(rows, spec, target, args.match_metric)
+            variant_steps = steps_to_match(rows, variant, target, args.match_metric)
+            matches.append(dict(sampler=variant,
+                                reference=spec,
+                                metric=args.match_metric,
+                                target=target,
+                                reference_steps=plain_steps,
+                                steps=variant_steps,
+                                steps_saved=None if variant_steps is None else plain_steps - variant_steps))
+            print("{sampler:>48} reaches {metric}>={target:.4f} in {steps} steps, {reference} in {reference_steps} "
+                  "(saved: {steps_saved})".format(**matches[-1]))
+        match_path = os.path.splitext(args.out)[0] + '_denoise.csv'
+        with open(match_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(matches[0]))
+            writer.writeheader()
+            writer.writerows(matches)
+        print(f"wrote {match_path}")
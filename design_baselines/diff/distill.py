@@ -0,0 +1,369 @@
+"""
+Distillation of a trained DDOM drift network into few-step students.
+
+Progressive distillation (Salimans & Ho 2022): every round trains a student to match two deterministic DDIM steps
+of its teacher with a single step, halving the number of steps; the first teacher is the classifier-free guided DDOM
+model, the next ones are the previous students. Every student starts from its teacher: the first one is a copy of
+the DDOM network with an extra, zero initialised guidance weight input, fitted to predict the teacher's clean design
+estimate through a v-prediction head, so one student covers a range of gammas.
+
+    python design_baselines/diff/trainer.py --mode distill --task dkitty ... --distill_teacher_steps 1024 \
+        --distill_min_steps 8
+    python design_baselines/diff/trainer.py --mode eval --task dkitty ... --sampler distilled --student_steps 8
+
+Consistency distillation (Song et al. 2023): a ConsistencyModel maps any point of a teacher probability flow ODE
+trajectory to its end point, so designs take one or a few network evaluations.
+
+    python design_baselines/diff/trainer.py --mode distill --distill_method consistency --task dkitty ...
+    python design_baselines/diff/trainer.py --mode eval --task dkitty ... --sampler consistency \
+        --consistency_sample_steps 2
+"""
+
+import copy
+import os
+
+import torch
+from torch import nn
+
+from nets import MLP, Swish
+from lib.sdes import VariancePreservingSDE, time_grid
+
+
+class DistilledStudent(nn.Module):
+    """
+    few-step clean design predictor on the VP SDE of its teacher, sampled with num_steps deterministic DDIM steps
+    uniform in t between T and t_epsilon
+    output is what the network predicts: 'x0' the clean design, or 'v' = mean_weight * eps - std * x0 (Salimans &
+    Ho 2022), from which x0 = mean_weight * x_t - std * v; unlike an eps or score output, whose clean design estimate
+    divides by mean_weight (about 6.5e-3 at T for beta_max = 20), v never amplifies the student's errors
+    it has the T and base_sde attributes of a reverse SDE, so the sampling utilities of lib.samplers accept it
+    """
+    kind = 'progressive_distillation'
+
+    def __init__(self, input_dim, hidden_dim, num_steps, beta_min=0.1, beta_max=20.0, T0=1., t_epsilon=0.001,
+                 output='x0'):
+        super().__init__()
+        assert output in ['x0', 'v'], f"unknown output {output}"
+        self.input_dim = input_dim
+        self.hidden_dim = hidden_dim
+        self.num_steps = num_steps
+        self.output = output
+        self.net = MLP(input_dim=input_dim, index_dim=2, hidden_dim=hidden_dim, act=Swish())
+        self.T = torch.nn.Parameter(torch.FloatTensor([T0]), requires_grad=False)
+        self.base_sde = VariancePreservingSDE(beta_min=beta_min, beta_max=beta_max, T=self.T, t_epsilon=t_epsilon)
+
+    @classmethod
+    def from_teacher(cls, gen_sde, num_steps):
+        """
+        v-predicting student with the architecture and the weights of the MLP of a DDOM reverse SDE: the first layer
+        takes [x, t, gamma, y] instead of [x, t, y] and its gamma column is zero; the copied output layer still
+        predicts the teacher's score or drift, fit_teacher turns it into a v head
+        """
+        mlp = gen_sde.a
+        assert isinstance(mlp, MLP) and mlp.index_dim == 1, "progressive distillation needs a DDOM MLP teacher"
+        base_sde = gen_sde.base_sde
+        student = cls(mlp.input_dim, mlp.hidden_dim, num_steps, beta_min=base_sde.beta_min, beta_max=base_sde.beta_max,
+                      T0=float(gen_sde.T), t_epsilon=base_sde.t_epsilon, output='v').to(gen_sde.T.device)
+        state = {k: v.clone() for k, v in mlp.state_dict().items()}
+        w = state['main.0.weight']
+        d = mlp.input_dim
+        state['main.0.weight'] = torch.cat([w[:, :d + 1], torch.zeros_like(w[:, :1]), w[:, d + 1:]], dim=1)
+        student.net.load_state_dict(state)
+        return student
+
+    def forward_times(self, num_steps=None):
+        """
+        forward times T = t_0 > ... > t_num_steps = t_epsilon of the sampling grid
+        """
+        num_steps = self.num_steps if num_steps is None else num_steps
+        ts = time_grid(self.base_sde, num_steps, 'uniform', t_stop=self.base_sde.t_epsilon, device=self.T.device)
+        return self.T - ts
+
+    def x0(self, x_t, t, ya, gamma=0.):
+        """
+        prediction of the clean design from x_t at forward time t, for condition ya and guidance weight gamma
+        """
+        n = x_t.size(0)
+        t = t.reshape(-1, 1).expand(n, 1)
+        gamma = torch.as_tensor(gamma, dtype=x_t.dtype, device=x_t.device).reshape(-1, 1).expand(n, 1)
+        out = self.net(x_t, torch.cat([t, gamma], dim=1), ya)
+        if self.output == 'x0':
+            return out
+        return self.base_sde.mean_weight(t) * x_t - self.base_sde.var(t)**0.5 * out
+
+    def checkpoint(self):
+        return dict(kind=self.kind,
+                    output=self.output,
+                    input_dim=self.input_dim,
+                    hidden_dim=self.hidden_dim,
+                    num_steps=self.num_steps,
+                    beta_min=self.base_sde.beta_min,
+                    beta_max=self.base_sde.beta_max,
+                    T0=float(self.T),
+                    t_epsilon=self.base_sde.t_epsilon,
+                    state_dict=self.state_dict())
+
+    @classmethod
+    def load(cls, path, device=None):
+        ckpt = torch.load(path, map_location=device)
+        assert ckpt['kind'] == cls.kind, f"{path} is a {ckpt['kind']} checkpoint, not {cls.kind}"
+        kwargs = {k: v for k, v in ckpt.items() if k not in ['kind', 'input_dim', 'hidden_dim', 'num_steps', 'state_dict']}
+        student = cls(ckpt['input_dim'], ckpt['hidden_dim'], ckpt['num_steps'], **kwargs)
+        student.load_state_dict(ckpt['state_dict'])
+        return student.to(device).eval()
+
+
+def ddim_step(base_sde, x_t, x0, t, s):
+    """
+    deterministic DDIM step from forward time t to s given the clean design prediction x0
+    """
+    alpha_t, std_t = base_sde.mean_weight(t), base_sde.var(t)**0.5
+    alpha_s, std_s = base_sde.mean_weight(s), base_sde.var(s)**0.5
+    eps = (x_t - alpha_t * x0) / std_t
+    return alpha_s * x0 + std_s * eps
+
+
+def teacher_x0(gen_sde, x_t, t, ya, gamma=0.):
+    """
+    clean design prediction of a trained (guided) DDOM reverse SDE
+    """
+    eps = gen_sde.epsilon(t, x_t, ya, gamma=gamma)
+    return (x_t - gen_sde.base_sde.var(t)**0.5 * eps) / gen_sde.base_sde.mean_weight(t)
+
+
+@torch.no_grad()
+def distilled_sampler(student, x_0, ya, num_steps, gamma=0., keep_all_samples=True, callback=None):
+    """
+    deterministic few-step sampler of a DistilledStudent; num_steps must be the number of steps it was distilled for
+    returns the list of kept samples and the number of network evaluations (NFE)
+    """
+    assert num_steps == student.num_steps, f"student was distilled for {student.num_steps} steps, not {num_steps}"
+    ts = student.forward_times()
+    xs = []
+    x_t = x_0.detach().clone().to(ts.device)
+    for i in range(num_steps):
+        x0 = student.x0(x_t, ts[i], ya, gamma=gamma)
+        x_t = ddim_step(student.base_sde, x_t, x0, ts[i], ts[i + 1])
+        if callback is not None:
+            callback(i, x_t)
+        if keep_all_samples or i == num_steps - 1:
+            xs.append(x_t.cpu())
+    return xs, num_steps
+
+
+def fit_teacher(teacher, student, x, y, num_iters, batch_size=256, learning_rate=1e-4, gamma_max=0.):
+    """
+    train student to predict the clean design estimate (Tweedie's formula, teacher_x0) of the DDOM reverse SDE
+    teacher, on designs x noised to times uniform in [t_epsilon, T]; this is the starting point of progressive
+    distillation, with the same guidance weights and loss as distillation_round
+    """
+    base_sde = student.base_sde
+    device = student.T.device
+    t_epsilon = base_sde.t_epsilon
+    optimizer = torch.optim.Adam(student.parameters(), lr=learning_rate)
+    student.train()
+    for it in range(num_iters):
+        idx = torch.randint(x.size(0), (batch_size, ), device=x.device)
+        x0, ya = x[idx].to(device), y[idx].to(device)
+        t = t_epsilon + torch.rand(batch_size, 1, device=device) * (student.T - t_epsilon)
+        gamma = torch.rand(batch_size, 1, device=device) * gamma_max
+        x_t = base_sde.mean_weight(t) * x0 + base_sde.var(t)**0.5 * torch.randn_like(x0)
+
+        with torch.no_grad():
+            target = teacher_x0(teacher, x_t, t, ya, gamma)
+            snr = base_sde.mean_weight(t)**2 / base_sde.var(t)
+
+        loss = (snr.clamp(min=1.) * (student.x0(x_t, t, ya, gamma) - target)**2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if it % 500 == 0 or it == num_iters - 1:
+            print(f"fit teacher iter={it} loss={loss.item():.4e}")
+    student.eval()
+    return student
+
+
+def distillation_round(teacher, student, x, y, num_iters, batch_size=256, learning_rate=1e-4, gamma_max=0.):
+    """
+    train student (student.num_steps steps) to match two DDIM steps of teacher (2 * student.num_steps steps) with
+    one, on designs x noised to the student's grid times; teacher is a DistilledStudent or a DDOM reverse SDE
+    guidance weights are drawn uniformly from [0, gamma_max] and given to both
+    the loss is the x-prediction error weighted by max(SNR, 1) (truncated SNR weighting)
+    """
+    base_sde = student.base_sde
+    device = student.T.device
+    ts = student.forward_times()
+    teacher_ts = student.forward_times(2 * student.num_steps)
+    optimizer = torch.optim.Adam(student.parameters(), lr=learning_rate)
+    student.train()
+    for it in range(num_iters):
+        idx = torch.randint(x.size(0), (batch_size, ), device=x.device)
+        x0, ya = x[idx].to(device), y[idx].to(device)
+        i = torch.randint(student.num_steps, (batch_size, 1), device=device)
+        gamma = torch.rand(batch_size, 1, device=device) * gamma_max
+        t, t_mid, s = ts[i], teacher_ts[2 * i + 1], ts[i + 1]
+        x_t = base_sde.mean_weight(t) * x0 + base_sde.var(t)**0.5 * torch.randn_like(x0)
+
+        with torch.no_grad():
+            if isinstance(teacher, DistilledStudent):
+                x_mid = ddim_step(base_sde, x_t, teacher.x0(x_t, t, ya, gamma), t, t_mid)
+                x_s = ddim_step(base_sde, x_mid, teacher.x0(x_mid, t_mid, ya, gamma), t_mid, s)
+            else:
+                x_mid = ddim_step(base_sde, x_t, teacher_x0(teacher, x_t, t, ya, gamma), t, t_mid)
+                x_s = ddim_step(base_sde, x_mid, teacher_x0(teacher, x_mid, t_mid, ya, gamma), t_mid, s)
+            # the clean design for which a single DDIM step from t lands on x_s
+            ratio = base_sde.var(s)**0.5 / base_sde.var(t)**0.5
+            target = (x_s - ratio * x_t) / (base_sde.mean_weight(s) - ratio * base_sde.mean_weight(t))
+            snr = base_sde.mean_weight(t)**2 / base_sde.var(t)
+
+        loss = (snr.clamp(min=1.) * (student.x0(x_t, t, ya, gamma) - target)**2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if it % 500 == 0 or it == num_iters - 1:
+            print(f"steps={student.num_steps} iter={it} loss={loss.item():.4e}")
+    student.eval()
+    return student
+
+
+def progressive_distillation(gen_sde,
+                             x,
+                             y,
+                             save_dir,
+                             teacher_steps=1024,
+                             min_steps=8,
+                             num_iters=2000,
+                             batch_size=256,
+                             learning_rate=1e-4,
+                             gamma_max=0.):
+    """
+    halve the number of steps from teacher_steps until min_steps, starting from the DDOM reverse SDE gen_sde and
+    the training designs x with their conditions y; every student is saved as <save_dir>/student_<steps>.pt and
+    initialised from its teacher, the first one from the DDOM MLP (DistilledStudent.from_teacher) fitted to the clean
+    design estimate of gen_sde for num_iters iterations (fit_teacher)
+    returns the last student
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    teacher = gen_sde
+    student = DistilledStudent.from_teacher(gen_sde, teacher_steps // 2)
+    student = fit_teacher(gen_sde, student, x, y, num_iters, batch_size=batch_size, learning_rate=learning_rate,
+                          gamma_max=gamma_max)
+    while student.num_steps >= min_steps:
+        student = distillation_round(teacher, student, x, y, num_iters, batch_size=batch_size,
+                                     learning_rate=learning_rate, gamma_max=gamma_max)
+        path = os.path.join(save_dir, f"student_{student.num_steps}.pt")
+        torch.save(student.checkpoint(), path)
+        print(f"saved {path}")
+        teacher = student
+        student = copy.deepcopy(teacher)
+        student.num_steps = teacher.num_steps // 2
+    return teacher
+
+
+class ConsistencyModel(DistilledStudent):
+    """
+    consistency function f(x_t, t) = c_skip(t) x_t / mean_weight(t) + c_out(t) F(x_t, t, y, gamma) of the VP SDE,
+    with the skip and output scalings of Karras et al. 2022 on sigma = std / mean_weight, so that f(x, t_epsilon) = x
+    num_steps is the discretisation of the teacher ODE it was trained on, sampling takes any number of steps
+    """
+    kind = 'consistency'
+
+    def __init__(self, input_dim, hidden_dim, num_steps, beta_min=0.1, beta_max=20.0, T0=1., t_epsilon=0.001,
+                 sigma_data=0.5, output='x0'):
+        super().__init__(input_dim, hidden_dim, num_steps, beta_min=beta_min, beta_max=beta_max, T0=T0,
+                         t_epsilon=t_epsilon, output=output)
+        self.sigma_data = sigma_data
+
+    def forward_times(self, num_steps=None, grid='edm'):
+        num_steps = self.num_steps if num_steps is None else num_steps
+        ts = time_grid(self.base_sde, num_steps, grid, t_stop=self.base_sde.t_epsilon, device=self.T.device)
+        return self.T - ts
+
+    def x0(self, x_t, t, ya, gamma=0.):
+        n = x_t.size(0)
+        t = t.reshape(-1, 1).expand(n, 1)
+        sigma = torch.exp(-self.base_sde.marginal_lambda(t))
+        sigma_min = torch.exp(-self.base_sde.marginal_lambda(torch.full_like(t, self.base_sde.t_epsilon)))
+        c_skip = self.sigma_data**2 / ((sigma - sigma_min)**2 + self.sigma_data**2)
+        c_out = self.sigma_data * (sigma - sigma_min) / (self.sigma_data**2 + sigma**2)**0.5
+        return c_skip * x_t / self.base_sde.mean_weight(t) + c_out * super().x0(x_t, t, ya, gamma=gamma)
+
+    def checkpoint(self):
+        return dict(super().checkpoint(), sigma_data=self.sigma_data)
+
+
+@torch.no_grad()
+def consistency_sampler(model, x_0, ya, num_steps=1, gamma=0., grid='uniform', keep_all_samples=True, callback=None,
+                        noise=torch.randn_like):
+    """
+    multistep consistency sampling: map the prior sample at T to a design, then for every further step re-noise it
+    to the next time of a num_steps grid between T and t_epsilon and map it back
+    returns the list of kept samples and the number of network evaluations (NFE)
+    """
+    base_sde = model.base_sde
+    ts = model.forward_times(num_steps, grid=grid)
+    xs = []
+    x_t = x_0.detach().clone().to(ts.device)
+    for i in range(num_steps):
+        if i > 0:
+            x_t = base_sde.mean_weight(ts[i]) * x + base_sde.var(ts[i])**0.5 * noise(x)
+        x = model.x0(x_t, ts[i], ya, gamma=gamma)
+        if callback is not None:
+            callback(i, x)
+        if keep_all_samples or i == num_steps - 1:
+            xs.append(x.cpu())
+    return xs, num_steps
+
+
+def consistency_distillation(gen_sde,
+                             x,
+                             y,
+                             save_path,
+                             hidden_dim=1024,
+                             num_steps=40,
+                             num_iters=20000,
+                             batch_size=256,
+                             learning_rate=1e-4,
+                             ema_decay=0.95,
+                             gamma_max=0.):
+    """
+    consistency distillation of the DDOM reverse SDE gen_sde on the training designs x and conditions y: adjacent
+    points t_n < t_n+1 of a num_steps EDM grid are linked by one DDIM (exponential integrator) step of the guided
+    teacher probability flow ODE, and the model is trained to give both points the same output as its EMA target
+    guidance weights are drawn uniformly from [0, gamma_max]; the model is saved to save_path and returned
+    """
+    base_sde = gen_sde.base_sde
+    device = gen_sde.T.device
+    model = ConsistencyModel(x.size(1), hidden_dim, num_steps, beta_min=base_sde.beta_min,
+                             beta_max=base_sde.beta_max, T0=float(gen_sde.T), t_epsilon=base_sde.t_epsilon,
+                             sigma_data=float(x.std())).to(device)
+    target = copy.deepcopy(model).requires_grad_(False)
+    ts = model.forward_times()
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    model.train()
+    for it in range(num_iters):
+        idx = torch.randint(x.size(0), (batch_size, ), device=x.device)
+        x0, ya = x[idx].to(device), y[idx].to(device)
+        n = torch.randint(num_steps, (batch_size, 1), device=device)
+        gamma = torch.rand(batch_size, 1, device=device) * gamma_max
+        # ts decreases: ts[n] is the noisier point
+        t, s = ts[n], ts[n + 1]
+        x_t = base_sde.mean_weight(t) * x0 + base_sde.var(t)**0.5 * torch.randn_like(x0)
+        with torch.no_grad():
+            x_s = ddim_step(base_sde, x_t, teacher_x0(gen_sde, x_t, t, ya, gamma), t, s)
+            y_target = target.x0(x_s, s, ya, gamma)
+
+        loss = ((model.x0(x_t, t, ya, gamma) - y_target)**2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        with torch.no_grad():
+            for p_target, p in zip(target.parameters(), model.parameters()):
+                p_target.mul_(ema_decay).add_(p, alpha=1. - ema_decay)
+        if it % 500 == 0 or it == num_iters - 1:
+            print(f"consistency iter={it} loss={loss.item():.4e}")
+    model.eval()
+    os.makedirs(os.path.dirname(save_path) or '.', exist_ok=True)
+    torch.save(model.checkpoint(), save_path)
+    print(f"saved {save_path}")
+    return model
@@ -0,0 +1,1077 @@
+import inspect
+import os
+import time
+
+import numpy as np
+import torch
+
+from lib.sdes import SamplingSchedule, time_grid
+
+
+def grid_schedule(gen_sde, num_steps, grid='uniform', t_stop=0.):
+    """
+    SamplingSchedule of a fixed step sampler: grid is the name of a time_grid strategy, or a tensor of
+    num_steps + 1 increasing reverse times
+    """
+    device = gen_sde.T.device
+    if torch.is_tensor(grid):
+        assert grid.numel() == num_steps + 1, f"grid has {grid.numel()} points, expected {num_steps + 1}"
+        ts = grid.to(device)
+    else:
+        ts = time_grid(gen_sde.base_sde, num_steps, grid=grid, t_stop=t_stop, device=device)
+    return SamplingSchedule(gen_sde.base_sde, ts)
+
+
+def tweedie_denoise(gen_sde, schedule, x_t, ya, gamma=0.):
+    """
+    posterior mean E[x_0 | x_t] = (x_t + std^2 score) / mean_weight at the last time of the schedule (Tweedie's
+    formula), i.e. a single jump from t_stop to the clean design
+    """
+    eps = gen_sde.epsilon_at(schedule, schedule.num_steps, x_t, ya, gamma=gamma)
+    return (x_t - schedule.std[-1] * eps) / schedule.alpha[-1]
+
+
+def denoise_last(gen_sde, schedule, xs, x_t, ya, nfe, gamma=0., callback=None):
+    """
+    the denoise option of the samplers: replaces the final state and the last kept sample in xs by its tweedie_denoise
+    estimate, calling callback on it as on the last step
+    returns the denoised state and nfe plus the one drift evaluation it costs
+    """
+    x_t = tweedie_denoise(gen_sde, schedule, x_t, ya, gamma=gamma)
+    if callback is not None:
+        callback(schedule.num_steps - 1, x_t)
+    xs[-1] = x_t.cpu()
+    return x_t, nfe + 1
+
+
+@torch.no_grad()
+def pc_sampler(gen_sde,
+               x_0,
+               ya,
+               num_steps,
+               lmbd=0.,
+               gamma=0.,
+               predictor='heun',
+               n_corrector=0,
+               snr=0.16,
+               fsal=True,
+               grid='uniform',
+               t_stop=0.,
+               denoise=False,
+               keep_all_samples=True,
+               callback=None,
+               noise=torch.randn_like):
+    """
+    predictor-corrector sampler (Song et al. 2021)
+    predictor 'euler' is Euler Maruyama; 'heun' is the stochastic Heun method, which averages the drift at both
+    ends of the step and shares the Brownian increment between the predictor and the corrector
+    with fsal=True the drift evaluated at the Heun predictor is reused as the drift at the start of the next step
+    (first-same-as-last, PEC mode), so the Heun predictor costs one drift evaluation per step instead of two
+    the corrector runs n_corrector Langevin steps after every step, sized from the batch averaged norms to the
+    target signal-to-noise ratio snr; the corrector moves the state, so it disables the drift reuse of that step
+    callback(i, x_t), if given, is called with the state after every step i
+    noise(x_t) draws the standard normal increments, torch.randn_like by default
+    grid and t_stop choose the time discretisation, see time_grid; with denoise, the state reached at t_stop is
+    replaced by its Tweedie estimate of the clean design (tweedie_denoise), for one more drift evaluation
+    returns the list of kept samples and the number of drift evaluations (NFE)
+    """
+    assert predictor in ['euler', 'heun'], f"unknown predictor {predictor}"
+    # init
+    device = gen_sde.T.device
+    schedule = grid_schedule(gen_sde, num_steps, grid=grid, t_stop=t_stop)
+
+    # sample
+    xs = []
+    nfe = 0
+    x_t = x_0.detach().clone().to(device)
+    mu = None
+    for i in range(num_steps):
+        if mu is None:
+            mu = gen_sde.mu_at(schedule, i, x_t, ya, lmbd=lmbd, gamma=gamma)
+            nfe += 1
+        sigma = gen_sde.sigma_at(schedule, i, lmbd=lmbd)
+        dw = schedule.sqrt_dt[i] * noise(x_t)
+        x_pred = x_t + schedule.dt[i] * mu + sigma * dw
+        # the drift at the end of the last step (t = 0) is never needed
+        if predictor == 'heun' and i < num_steps - 1:
+            mu_next = gen_sde.mu_at(schedule, i + 1, x_pred, ya, lmbd=lmbd, gamma=gamma)
+            nfe += 1
+            sigma_next = gen_sde.sigma_at(schedule, i + 1, lmbd=lmbd)
+            x_t = x_t + 0.5 * schedule.dt[i] * (mu + mu_next) + 0.5 * (sigma + sigma_next) * dw
+            mu = mu_next if fsal else None
+        else:
+            x_t = x_pred
+            mu = None
+
+        if n_corrector > 0 and i < num_steps - 1:
+            for _ in range(n_corrector):
+                score = -gen_sde.epsilon_at(schedule, i + 1, x_t, ya, gamma=gamma) / schedule.std[i + 1]
+                nfe += 1
+                z = noise(x_t)
+                z_norm = z.reshape(z.size(0), -1).norm(dim=1).mean()
+                score_norm = score.reshape(score.size(0), -1).norm(dim=1).mean().clamp(min=1e-12)
+                step_size = 2 * (snr * z_norm / score_norm)**2
+                x_t = x_t + step_size * score + (2 * step_size)**0.5 * z
+            mu = None
+
+        if callback is not None:
+            callback(i, x_t)
+        if keep_all_samples or i == num_steps - 1:
+            xs.append(x_t.cpu())
+    if denoise:
+        x_t, nfe = denoise_last(gen_sde, schedule, xs, x_t, ya, nfe, gamma=gamma, callback=callback)
+    return xs, nfe
+
+
+@torch.no_grad()
+def heun_sampler(gen_sde,
+                 x_0,
+                 ya,
+                 num_steps,
+                 lmbd=0.,
+                 gamma=0.,
+                 fsal=True,
+                 grid='uniform',
+                 t_stop=0.,
+                 denoise=False,
+                 keep_all_samples=True,
+                 callback=None,
+                 noise=torch.randn_like):
+    """
+    stochastic Heun method, see pc_sampler
+    returns the list of kept samples and the number of drift evaluations (NFE)
+    """
+    return pc_sampler(gen_sde,
+                      x_0,
+                      ya,
+                      num_steps,
+                      lmbd=lmbd,
+                      gamma=gamma,
+                      predictor='heun',
+                      fsal=fsal,
+                      grid=grid,
+                      t_stop=t_stop,
+                      denoise=denoise,
+                      keep_all_samples=keep_all_samples,
+                      callback=callback,
+                      noise=noise)
+
+
+@torch.no_grad()
+def euler_maruyama_sampler(gen_sde,
+                           x_0,
+                           ya,
+                           num_steps,
+                           lmbd=0.,
+                           gamma=0.,
+                           grid='uniform',
+                           t_stop=0.,
+                           denoise=False,
+                           keep_all_samples=True,
+                           callback=None,
+                           noise=torch.randn_like):
+    """
+    Euler Maruyama method with a step size delta
+    grid and t_stop choose the time discretisation, see time_grid; with denoise, the state reached at t_stop is
+    replaced by its Tweedie estimate of the clean design (tweedie_denoise), for one more drift evaluation
+    returns the list of kept samples and the number of drift evaluations (NFE)
+    """
+    # init
+    device = gen_sde.T.device
+    schedule = grid_schedule(gen_sde, num_steps, grid=grid, t_stop=t_stop)
+
+    # sample
+    xs = []
+    nfe = 0
+    x_t = x_0.detach().clone().to(device)
+    for i in range(num_steps):
+        mu = gen_sde.mu_at(schedule, i, x_t, ya, lmbd=lmbd, gamma=gamma)
+        nfe += 1
+        sigma = gen_sde.sigma_at(schedule, i, lmbd=lmbd)
+        x_t = x_t + schedule.dt[i] * mu + schedule.sqrt_dt[i] * sigma * noise(
+            x_t
+        )  # one step update of Euler Maruyama method with a step size delta
+        if callback is not None:
+            callback(i, x_t)
+        if keep_all_samples or i == num_steps - 1:
+            xs.append(x_t.cpu())
+    if denoise:
+        x_t, nfe = denoise_last(gen_sde, schedule, xs, x_t, ya, nfe, gamma=gamma, callback=callback)
+    return xs, nfe
+
+
+@torch.no_grad()
+def picard_sampler(gen_sde,
+                   x_0,
+                   ya,
+                   num_steps,
+                   lmbd=0.,
+                   gamma=0.,
+                   window=16,
+                   tol=1e-3,
+                   grid='uniform',
+                   t_stop=0.,
+                   denoise=False,
+                   keep_all_samples=True,
+                   callback=None,
+                   noise=torch.randn_like,
+                   stats=None):
+    """
+    parallel-in-time Euler Maruyama (Picard iterations on a sliding window, ParaDiGMS, Shih et al. 2023):
+    the states of the next `window` steps are guessed, the drift is evaluated at all of them in one batch of
+    window * B, and the guesses are replaced by the cumulated increments; the steps whose guesses changed by less
+    than tol (root mean square per dimension, worst sample) are accepted and the window slides past them
+    the noise of every step is drawn once, in step order, so the trajectories converge to those of
+    euler_maruyama_sampler with the same noise, up to tol; larger windows trade more total drift evaluations for
+    fewer sequential ones, which is what bounds the latency of a small batch on a many-core machine
+    designs must be flat, of shape (B, dim)
+    returns the list of kept samples and the total number of drift evaluations per sample (the sum of the window
+    sizes), like the NFE of the other samplers; with a dict stats, the number of sequential (batched) evaluations,
+    at most num_steps, is stored in stats['sequential_nfe']
+    """
+    # init
+    device = gen_sde.T.device
+    schedule = grid_schedule(gen_sde, num_steps, grid=grid, t_stop=t_stop)
+    window = min(window, num_steps)
+
+    def repeat(v, w):
+        return v.repeat(w, 1) if torch.is_tensor(v) and v.dim() > 0 else v
+
+    # sample
+    xs = []
+    nfe, sequential_nfe = 0, 0
+    x_t = x_0.detach().clone().to(device)
+    n = x_t.size(0)
+    # states[k] is the guess of the state before step p + k, states[0] is accepted
+    states = x_t.unsqueeze(0).repeat(window + 1, 1, 1)
+    zs = []
+    p = 0
+    while p < num_steps:
+        w = min(window, num_steps - p)
+        while len(zs) < w:
+            zs.append(noise(x_t))
+        i = torch.arange(p, p + w, device=device).repeat_interleave(n).view(-1, 1)
+        y = states[:w].reshape(w * n, -1)
+        mu = gen_sde.mu_at(schedule, i, y, ya.repeat(w), lmbd=repeat(lmbd, w), gamma=repeat(gamma, w))
+        nfe += w
+        sequential_nfe += 1
+        sigma = gen_sde.sigma_at(schedule, i, lmbd=repeat(lmbd, w))
+        increments = (schedule.dt[i] * mu + schedule.sqrt_dt[i] * sigma * torch.cat(zs[:w])).view(w, n, -1)
+        new = states[0] + increments.cumsum(0)
+        err = ((new - states[1:w + 1])**2).mean(2).max(1)[0]
+        states[1:w + 1] = new
+        # the first step is exact, the others are accepted up to the first one that has not converged
+        bad = (err > tol**2).nonzero()
+        stride = max(1, int(bad[0]) if bad.numel() > 0 else w)
+        for k in range(1, stride + 1):
+            if callback is not None:
+                callback(p + k - 1, states[k])
+            if keep_all_samples or p + k == num_steps:
+                xs.append(states[k].cpu())
+        x_t = states[stride]
+        # slide the window, the new steps start from the last guess
+        states = torch.cat([states[stride:], states[-1:].repeat(stride, 1, 1)])
+        zs = zs[stride:]
+        p += stride
+    if denoise:
+        x_t, nfe = denoise_last(gen_sde, schedule, xs, x_t, ya, nfe, gamma=gamma, callback=callback)
+        sequential_nfe += 1
+    if stats is not None:
+        stats['sequential_nfe'] = sequential_nfe
+    return xs, nfe
+
+
+# Dormand-Prince 5(4) Butcher tableau
+DOPRI_C = [0., 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1., 1.]
+DOPRI_A = [
+    [],
+    [1 / 5],
+    [3 / 40, 9 / 40],
+    [44 / 45, -56 / 15, 32 / 9],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+    [35 / 384, 0., 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+]
+DOPRI_B5 = DOPRI_A[6] + [0.]
+DOPRI_B4 = [5179 / 57600, 0., 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40]
+
+
+@torch.no_grad()
+def ode_sampler(gen_sde,
+                x_0,
+                ya,
+                gamma=0.,
+                rtol=1e-3,
+                atol=1e-3,
+                h_init=None,
+                safety=0.9,
+                max_steps=10000,
+                keep_all_samples=True):
+    """
+    probability flow ODE of the VP SDE, integrated with the adaptive Dormand-Prince 5(4) pair
+    the ODE drift is the reverse SDE drift with lmbd=1, i.e. -f + 0.5 g^2 score, so it works for both
+    the drift and the score parameterisation; integration stops at t_epsilon like the SDE training does
+    the first-same-as-last property of the tableau is used, so an accepted step costs 6 drift evaluations
+    returns the list of kept samples and the number of drift evaluations (NFE)
+    """
+    # init
+    device = gen_sde.T.device
+    T_ = gen_sde.T.cpu().item()
+    t_end = T_ - gen_sde.base_sde.t_epsilon
+    h = h_init if h_init is not None else 0.02 * t_end
+
+    def drift(s, x):
+        return gen_sde.mu(torch.full((1, ), s, device=device), x, ya, lmbd=1., gamma=gamma)
+
+    # sample
+    xs = []
+    nfe = 0
+    s = 0.
+    x_t = x_0.detach().clone().to(device)
+    k1 = drift(s, x_t)
+    nfe += 1
+    for _ in range(max_steps):
+        if s >= t_end:
+            break
+        h = min(h, t_end - s)
+        ks = [k1]
+        for j in range(1, 7):
+            x_j = x_t + h * sum(a_ij * k for a_ij, k in zip(DOPRI_A[j], ks) if a_ij != 0.)
+            ks.append(drift(s + DOPRI_C[j] * h, x_j))
+            nfe += 1
+        # x_j of the last stage is the fifth order solution
+        x_new = x_j
+        err = h * sum((b5 - b4) * k for b5, b4, k in zip(DOPRI_B5, DOPRI_B4, ks))
+        scale = atol + rtol * torch.max(x_t.abs(), x_new.abs())
+        err_norm = (err / scale).pow(2).mean().sqrt().item()
+
+        if err_norm <= 1.:
+            s = t_end if h >= t_end - s else s + h
+            x_t = x_new
+            k1 = ks[-1]
+            if keep_all_samples:
+                xs.append(x_t.cpu())
+        # standard step size controller for an embedded pair of order 4
+        if err_norm == 0.:
+            factor = 10.
+        else:
+            factor = min(10., max(0.2, safety * err_norm**(-1 / 5)))
+        h = h * factor
+    if s < t_end:
+        print(f"ode_sampler: reached max_steps={max_steps} at t={s:.4f}")
+
+    if not keep_all_samples:
+        xs.append(x_t.cpu())
+    return xs, nfe
+
+
+@torch.no_grad()
+def dpm_solver_sampler(gen_sde,
+                       x_0,
+                       ya,
+                       num_steps,
+                       order=2,
+                       gamma=0.,
+                       grid='logsnr',
+                       t_stop=None,
+                       denoise=False,
+                       keep_all_samples=True,
+                       callback=None):
+    """
+    multistep DPM-Solver (Lu et al. 2022) for the VP SDE
+    the linear part -0.5 beta(t) y of the drift is integrated exactly and only the noise prediction
+    is approximated, by a polynomial in the half log-SNR lambda built from the cached outputs of the
+    previous steps; by default time steps are uniform in lambda between T and t_epsilon (grid='logsnr')
+    lower orders are used for the first steps (not enough history yet) and for the last steps
+    with denoise, the state reached at t_stop is replaced by its Tweedie estimate of the clean design
+    returns the list of kept samples and the number of drift evaluations (NFE)
+    """
+    assert order in [1, 2, 3], f"order must be 1, 2 or 3, got {order}"
+    # init
+    base_sde = gen_sde.base_sde
+    device = gen_sde.T.device
+    t_stop = base_sde.t_epsilon if t_stop is None else t_stop
+    schedule = grid_schedule(gen_sde, num_steps, grid=grid, t_stop=t_stop)
+    lambdas = base_sde.marginal_lambda(schedule.t_fwd)
+    assert torch.isfinite(lambdas).all(), "dpm_solver_sampler needs a grid that stops before t = 0"
+    log_alphas = schedule.log_alpha
+    sigmas = schedule.std
+
+    # sample
+    xs = []
+    nfe = 0
+    x_t = x_0.detach().clone().to(device)
+    eps_list = [gen_sde.epsilon_at(schedule, 0, x_t, ya, gamma=gamma)]
+    nfe += 1
+    for i in range(1, num_steps + 1):
+        step_order = min(order, i, num_steps + 1 - i)
+        h = lambdas[i] - lambdas[i - 1]
+        phi_1 = torch.expm1(h)
+        x_t = torch.exp(log_alphas[i] - log_alphas[i - 1]) * x_t - sigmas[i] * phi_1 * eps_list[-1]
+        if step_order >= 2:
+            r0 = (lambdas[i - 1] - lambdas[i - 2]) / h
+            d1_0 = (eps_list[-1] - eps_list[-2]) / r0
+            if step_order == 2:
+                x_t = x_t - 0.5 * sigmas[i] * phi_1 * d1_0
+            else:
+                r1 = (lambdas[i - 2] - lambdas[i - 3]) / h
+                d1_1 = (eps_list[-2] - eps_list[-3]) / r1
+                d1 = d1_0 + r0 / (r0 + r1) * (d1_0 - d1_1)
+                d2 = (d1_0 - d1_1) / (r0 + r1)
+                phi_2 = phi_1 / h - 1.
+                phi_3 = phi_2 / h - 0.5
+                x_t = x_t - sigmas[i] * phi_2 * d1 - sigmas[i] * phi_3 * d2
+
+        if i < num_steps:
+            eps_list.append(gen_sde.epsilon_at(schedule, i, x_t, ya, gamma=gamma))
+            nfe += 1
+            # only the last `order` outputs are needed by the multistep update
+            eps_list = eps_list[-order:]
+
+        if callback is not None:
+            callback(i - 1, x_t)
+        if keep_all_samples or i == num_steps:
+            xs.append(x_t.cpu())
+    if denoise:
+        x_t, nfe = denoise_last(gen_sde, schedule, xs, x_t, ya, nfe, gamma=gamma, callback=callback)
+    return xs, nfe
+
+
+@torch.no_grad()
+def ddim_sampler(gen_sde,
+                 x_0,
+                 ya,
+                 num_steps,
+                 eta=0.,
+                 gamma=0.,
+                 grid='uniform',
+                 t_stop=None,
+                 denoise=False,
+                 keep_all_samples=True,
+                 callback=None,
+                 noise=torch.randn_like):
+    """
+    DDIM (Song et al. 2021) for the continuous time VP SDE
+    the network output is converted to a noise prediction, which gives a prediction of the clean design,
+    and each step jumps to the VP marginal at the next time of the grid, uniform between T and t_epsilon by default
+    eta=0 is deterministic, eta=1 matches the ancestral (DDPM-like) sampler
+    with denoise, the state reached at t_stop is replaced by its Tweedie estimate of the clean design
+    returns the list of kept samples and the number of drift evaluations (NFE)
+    """
+    # init
+    base_sde = gen_sde.base_sde
+    device = gen_sde.T.device
+    t_stop = base_sde.t_epsilon if t_stop is None else t_stop
+    schedule = grid_schedule(gen_sde, num_steps, grid=grid, t_stop=t_stop)
+    alphas = schedule.alpha
+    variances = schedule.std**2
+
+    # sample
+    xs = []
+    nfe = 0
+    x_t = x_0.detach().clone().to(device)
+    for i in range(num_steps):
+        eps = gen_sde.epsilon_at(schedule, i, x_t, ya, gamma=gamma)
+        nfe += 1
+        x0_pred = (x_t - variances[i]**0.5 * eps) / alphas[i]
+        sigma = eta * (variances[i + 1] / variances[i] *
+                       (1. - alphas[i]**2 / alphas[i + 1]**2)).clamp(min=0.)**0.5
+        x_t = alphas[i + 1] * x0_pred + (variances[i + 1] - sigma**2).clamp(min=0.)**0.5 * eps
+        if eta > 0:
+            x_t = x_t + sigma * noise(x_t)
+
+        if callback is not None:
+            callback(i, x_t)
+        if keep_all_samples or i == num_steps - 1:
+            xs.append(x_t.cpu())
+    if denoise:
+        x_t, nfe = denoise_last(gen_sde, schedule, xs, x_t, ya, nfe, gamma=gamma, callback=callback)
+    return xs, nfe
+
+
+def _as_int64(c):
+    c = c % 2**64
+    return c - 2**64 if c >= 2**63 else c
+
+
+# splitmix64 constants, as signed int64
+_GOLDEN = _as_int64(0x9e3779b97f4a7c15)
+_MIX_1 = _as_int64(0xbf58476d1ce4e5b9)
+_MIX_2 = _as_int64(0x94d049bb133111eb)
+
+
+def _shr(z, k):
+    # logical right shift of int64 tensors (>> is arithmetic)
+    return (z >> k) & ((1 << (64 - k)) - 1)
+
+
+def _mix64(z):
+    """
+    splitmix64 finaliser, elementwise on int64 tensors (multiplications wrap around)
+    """
+    z = (z ^ _shr(z, 30)) * _MIX_1
+    z = (z ^ _shr(z, 27)) * _MIX_2
+    return z ^ _shr(z, 31)
+
+
+class NoiseBank(object):
+    """
+    counter-based standard normal noise: element j of the k-th draw of sample index n is a hash of
+    (seed, stream, n, k, j), so a design slot sees the same prior and the same increments whatever the batch size,
+    chunking, device or worker it is sampled in, and sweeps over conditions or guidance weights share their noise
+    seed and stream may be ints or per-sample tensors; the prior is a draw of its own (k = -1)
+    use as the `noise` argument of the samplers, it counts its draws; normals are made by Box-Muller from the two
+    32 bit halves of the hash, in float64 so that they are identical across devices up to the final cast
+    """
+    def __init__(self, seed, indices, stream=0, device=None):
+        indices = torch.as_tensor(indices, dtype=torch.long, device=device).reshape(-1, 1)
+        seed = torch.as_tensor(seed, dtype=torch.long, device=indices.device).reshape(-1, 1)
+        stream = torch.as_tensor(stream, dtype=torch.long, device=indices.device).reshape(-1, 1)
+        key = _mix64(_mix64(seed + _GOLDEN) + stream * _GOLDEN)
+        self.keys = _mix64(key + indices * _GOLDEN)
+        self.indices = indices.view(-1)
+        self.num_draws = 0
+
+    def draw(self, k, shape, dtype=torch.float32):
+        n = self.keys.size(0)
+        numel = int(np.prod(shape))
+        j = torch.arange(numel, dtype=torch.long, device=self.keys.device).view(1, -1)
+        h = _mix64(_mix64(self.keys + _as_int64((k + 1) * _GOLDEN)) + j * _GOLDEN)
+        u1 = (_shr(h, 32).double() + 0.5) / 2.**32
+        u2 = ((h & 0xffffffff).double() + 0.5) / 2.**32
+        z = torch.sqrt(-2. * torch.log(u1)) * torch.cos(2. * np.pi * u2)
+        return z.to(dtype).view(n, *shape)
+
+    def prior(self, *shape, dtype=torch.float32):
+        return self.draw(-1, shape, dtype=dtype)
+
+    def __call__(self, x_t):
+        z = self.draw(self.num_draws, x_t.shape[1:], dtype=x_t.dtype)
+        self.num_draws += 1
+        return z
+
+
+def _takes(sampler, name):
+    return name in inspect.signature(sampler).parameters
+
+
+@torch.no_grad()
+def stream_samples(sampler,
+                   gen_sde,
+                   path,
+                   num_samples,
+                   dim,
+                   condition,
+                   num_steps,
+                   snapshot_stride=None,
+                   snapshot_steps=None,
+                   chunk_size=512,
+                   seed=None,
+                   **sampler_kwargs):
+    """
+    draw num_samples designs with a fixed grid sampler in chunks of chunk_size, writing only the states after the
+    requested steps (every snapshot_stride steps, or the explicit list snapshot_steps) into a preallocated .npy file
+    opened as a memory map, so that at most one step of one chunk is held in memory
+    the last step is always written, i.e. the final designs are the last slice
+    the step indices are saved next to the array as <path>_steps.npy
+    with a seed, the prior and the noise come from a NoiseBank keyed by the sample index, so the designs do not
+    depend on chunk_size
+    returns the memory mapped array of shape (num_snapshots, num_samples, dim), the step indices and the NFE
+    """
+    if snapshot_steps is None:
+        stride = snapshot_stride if snapshot_stride else num_steps
+        snapshot_steps = range(stride - 1, num_steps, stride)
+    snapshot_steps = sorted(set(int(i) for i in snapshot_steps if 0 <= i < num_steps) | {num_steps - 1})
+    slots = {step: k for k, step in enumerate(snapshot_steps)}
+
+    out = np.lib.format.open_memmap(path,
+                                    mode='w+',
+                                    dtype=np.float32,
+                                    shape=(len(snapshot_steps), num_samples, dim))
+    np.save(os.path.splitext(path)[0] + '_steps.npy', np.array(snapshot_steps))
+
+    device = gen_sde.T.device
+    nfe = 0
+    for start in range(0, num_samples, chunk_size):
+        end = min(start + chunk_size, num_samples)
+        if seed is not None:
+            bank = NoiseBank(seed, torch.arange(start, end), device=device)
+            x_0 = bank.prior(dim)  # init from prior
+            if _takes(sampler, 'noise'):
+                sampler_kwargs['noise'] = bank
+        else:
+            x_0 = torch.randn(end - start, dim, device=device)  # init from prior
+        ya = torch.ones(end - start, device=device) * condition
+
+        def write(i, x_t):
+            if i in slots:
+                out[slots[i], start:end] = x_t.cpu().numpy()
+
+        _, chunk_nfe = sampler(gen_sde, x_0, ya, num_steps, keep_all_samples=False, callback=write, **sampler_kwargs)
+        nfe += chunk_nfe
+    out.flush()
+    return out, snapshot_steps, nfe
+
+
+def elbo_scores(gen_sde, designs, num_probes=8, chunk_size=512):
+    """
+    in-distribution score of every design: the ELBO of the unconditional model (ya = 0) averaged over num_probes
+    independent (t, noise, Hutchinson probe) draws of elbo_random_t_slice, all probes of a chunk of designs in one
+    batch of chunk_size * num_probes; designs may be a tensor or a (memory mapped) array, and only one chunk is
+    held at a time, with no graph kept across chunks
+    returns the mean ELBO and the variance of a single probe per design, as numpy arrays of shape (N, ), so the
+    variance of the mean is variance / num_probes
+    """
+    device = gen_sde.T.device
+    training = gen_sde.training
+    gen_sde.eval()
+    mean = np.empty(len(designs), dtype=np.float32)
+    var = np.empty(len(designs), dtype=np.float32)
+    for start in range(0, len(designs), chunk_size):
+        end = min(start + chunk_size, len(designs))
+        x = torch.as_tensor(np.asarray(designs[start:end]), dtype=torch.float32, device=device)
+        x = x.reshape(end - start, -1).repeat(num_probes, 1)
+        elbo = gen_sde.elbo_random_t_slice(x, torch.zeros(x.size(0), 1, device=device))
+        elbo = elbo.detach().view(num_probes, end - start)
+        mean[start:end] = elbo.mean(0).cpu().numpy()
+        var[start:end] = (elbo.var(0) if num_probes > 1 else torch.zeros_like(elbo[0])).cpu().numpy()
+    gen_sde.train(training)
+    return mean, var
+
+
+class DivergenceGuard(object):
+    """
+    sampler callback keeping a per-sample validity mask: a trajectory fails the first time its state is not finite
+    (or leaves [-bound, bound]) and is then frozen at zero so that it cannot produce NaNs downstream
+    with clamp, every state is first clamped to [-clamp, clamp] in place
+    """
+    def __init__(self, batch_size, device=None, clamp=None, bound=None):
+        self.clamp = clamp
+        self.bound = bound
+        self.valid = torch.ones(batch_size, dtype=torch.bool, device=device)
+        self.failed_step = torch.full((batch_size, ), -1, dtype=torch.long, device=device)
+
+    def __call__(self, i, x_t):
+        if self.clamp is not None:
+            x_t.clamp_(-self.clamp, self.clamp)
+        flat = x_t.reshape(x_t.size(0), -1)
+        bad = ~torch.isfinite(flat).all(dim=1)
+        if self.bound is not None:
+            bad = bad | (flat.abs() > self.bound).any(dim=1)
+        self.failed_step = torch.where(bad & self.valid, torch.full_like(self.failed_step, i), self.failed_step)
+        self.valid = self.valid & ~bad
+        mask = self.valid.view(-1, *([1] * (x_t.dim() - 1)))
+        x_t.copy_(torch.where(mask, x_t, torch.zeros_like(x_t)))
+
+
+@torch.no_grad()
+def sample_valid(sampler,
+                 gen_sde,
+                 num_samples,
+                 dim,
+                 condition,
+                 num_steps,
+                 max_rounds=5,
+                 clamp=None,
+                 bound=None,
+                 seed=None,
+                 first_index=0,
+                 allow_empty=False,
+                 **sampler_kwargs):
+    """
+    draw num_samples designs with a fixed grid sampler, tracking the validity of every trajectory with a
+    DivergenceGuard and resampling only the failed slots, for at most max_rounds extra rounds
+    with a seed, slot n of round r draws its prior and noise from NoiseBank(seed, first_index + n, stream=r)
+    returns the valid designs (fewer than num_samples only if failures remain after max_rounds; unless allow_empty,
+    a RuntimeError is raised if none is left) and a dict with
+    the NFE, the sequential NFE (fewer than the NFE for picard_sampler, which evaluates several steps at once),
+    the per-sample failure rate and the wasted sample-NFE (drift evaluations spent on failed trajectories)
+    """
+    device = gen_sde.T.device
+    designs = torch.empty(num_samples, dim)
+    missing = torch.arange(num_samples)
+    nfe, sequential_nfe, sample_nfe, wasted_sample_nfe, num_failed, num_drawn = 0, 0, 0, 0, 0, 0
+    for r in range(max_rounds + 1):
+        n = missing.numel()
+        if seed is not None:
+            bank = NoiseBank(seed, first_index + missing, stream=r, device=device)
+            x_0 = bank.prior(dim)  # init from prior
+            if _takes(sampler, 'noise'):
+                sampler_kwargs['noise'] = bank
+        else:
+            x_0 = torch.randn(n, dim, device=device)  # init from prior
+        ya = torch.ones(n, device=device) * condition
+        guard = DivergenceGuard(n, device=device, clamp=clamp, bound=bound)
+        round_stats = {}
+        if _takes(sampler, 'stats'):
+            sampler_kwargs['stats'] = round_stats
+        xs, round_nfe = sampler(gen_sde, x_0, ya, num_steps, keep_all_samples=False, callback=guard,
+                                **sampler_kwargs)
+        valid = guard.valid.cpu()
+        designs[missing[valid]] = xs[-1][valid]
+        nfe += round_nfe
+        sequential_nfe += round_stats.get('sequential_nfe', round_nfe)
+        sample_nfe += round_nfe * n
+        num_drawn += n
+        num_failed += int((~valid).sum())
+        # every trajectory is integrated to the end in the batch, so a failed one wastes all of its evaluations
+        wasted_sample_nfe += round_nfe * int((~valid).sum())
+        missing = missing[~valid]
+        if missing.numel() == 0:
+            break
+
+    if not allow_empty and num_samples > 0 and missing.numel() == num_samples:
+        raise RuntimeError(f"sample_valid: no valid design after {max_rounds} resampling rounds, all {num_samples} "
+                           f"trajectories diverged")
+    if missing.numel() > 0:
+        print(f"sample_valid: {missing.numel()} of {num_samples} samples still invalid after {max_rounds} resampling rounds")
+        keep = torch.ones(num_samples, dtype=torch.bool)
+        keep[missing] = False
+        designs = designs[keep]
+
+    stats = dict(nfe=nfe,
+                 sequential_nfe=sequential_nfe,
+                 sample_nfe=sample_nfe,
+                 wasted_sample_nfe=wasted_sample_nfe,
+                 failure_rate=num_failed / num_drawn,
+                 num_invalid=missing.numel(),
+                 num_drawn=num_drawn)
+    return designs, stats
+
+
+def _shard_worker(rank, sampler, gen_sde, out, counts, stats, bounds, dim, condition, num_steps, num_threads,
+                  sampler_kwargs):
+    torch.set_num_threads(num_threads)
+    start, end = int(bounds[rank]), int(bounds[rank + 1])
+    # a shard may come back empty, sharded_sample checks the total
+    designs, shard_stats = sample_valid(sampler, gen_sde, end - start, dim, condition, num_steps, first_index=start,
+                                        allow_empty=True, **sampler_kwargs)
+    out[start:start + designs.size(0)] = designs
+    counts[rank] = designs.size(0)
+    stats[rank] = torch.tensor([shard_stats['nfe'], shard_stats['sample_nfe'], shard_stats['wasted_sample_nfe'],
+                                shard_stats['failure_rate'] * shard_stats['num_drawn'], shard_stats['num_invalid'],
+                                shard_stats['num_drawn'], shard_stats['sequential_nfe']], dtype=torch.float64)
+
+
+def shard_config(num_workers=None, num_threads=None):
+    """
+    number of worker processes and intra-op threads per worker for the cores this process may run on:
+    by default one worker per core, and the cores are split evenly between the workers
+    """
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    if num_workers is None:
+        num_workers = cores if num_threads is None else max(1, cores // num_threads)
+    if num_threads is None:
+        num_threads = max(1, cores // num_workers)
+    return num_workers, num_threads
+
+
+@torch.no_grad()
+def sharded_sample(sampler,
+                   gen_sde,
+                   num_samples,
+                   dim,
+                   condition,
+                   num_steps,
+                   num_workers=None,
+                   num_threads=None,
+                   seed=None,
+                   **sampler_kwargs):
+    """
+    sample_valid split over forked CPU worker processes, each with its own intra-op thread pool of num_threads
+    threads and a disjoint range of design indices; the drift network and the output buffer live in shared memory,
+    so nothing is copied or reloaded per worker
+    designs draw their noise from NoiseBank(seed, design index), so the result does not depend on the sharding
+    returns the valid designs and the stats of sample_valid summed over the workers (nfe and sequential_nfe are the
+    largest per worker)
+    """
+    assert gen_sde.T.device.type == 'cpu', "sharded_sample runs on CPU"
+    num_workers, num_threads = shard_config(num_workers, num_threads)
+    num_workers = min(num_workers, num_samples)
+    if seed is None:
+        # forked workers inherit the same global RNG state, so the shards need a shared seed instead
+        seed = int(torch.randint(2**31 - 1, (1, )))
+    gen_sde.share_memory()
+    out = torch.empty(num_samples, dim).share_memory_()
+    counts = torch.zeros(num_workers, dtype=torch.long).share_memory_()
+    stats = torch.zeros(num_workers, 7, dtype=torch.float64).share_memory_()
+    bounds = np.linspace(0, num_samples, num_workers + 1).astype(int)
+    ctx = torch.multiprocessing.get_context('fork')
+    workers = [
+        ctx.Process(target=_shard_worker,
+                    args=(rank, sampler, gen_sde, out, counts, stats, bounds, dim, condition, num_steps, num_threads,
+                          dict(sampler_kwargs, seed=seed))) for rank in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [rank for rank, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"sharded_sample: workers {failed} failed")
+
+    designs = torch.cat([out[int(bounds[rank]):int(bounds[rank]) + int(counts[rank])] for rank in range(num_workers)])
+    if num_samples > 0 and designs.size(0) == 0:
+        raise RuntimeError(f"sharded_sample: no valid design, all {num_samples} trajectories diverged")
+    stats = dict(nfe=int(stats[:, 0].max()),
+                 sequential_nfe=int(stats[:, 6].max()),
+                 sample_nfe=int(stats[:, 1].sum()),
+                 wasted_sample_nfe=int(stats[:, 2].sum()),
+                 failure_rate=float(stats[:, 3].sum() / stats[:, 5].sum()),
+                 num_invalid=int(stats[:, 4].sum()),
+                 num_drawn=int(stats[:, 5].sum()))
+    return designs, stats
+
+
+def tune_shards(sampler, gen_sde, dim, condition, num_steps, num_samples=256, **sampler_kwargs):
+    """
+    pick the (num_workers, num_threads) split of the cores with the highest sharded_sample throughput on a short
+    probe of num_samples designs, trying 1, 2, 4, ... threads per worker
+    """
+    cores, _ = shard_config(num_threads=1)
+    best, best_rate = None, 0.
+    num_threads = 1
+    while num_threads <= cores:
+        config = shard_config(num_threads=num_threads)
+        start = time.perf_counter()
+        sharded_sample(sampler, gen_sde, num_samples, dim, condition, num_steps, *config, **sampler_kwargs)
+        rate = num_samples / (time.perf_counter() - start)
+        print(f"tune_shards: {config[0]} workers x {config[1]} threads, {rate:.1f} designs/s")
+        if rate > best_rate:
+            best, best_rate = config, rate
+        num_threads *= 2
+    return best
+
+
+@torch.no_grad()
+def grid_sample(sampler, gen_sde, configs, num_samples, dim, num_steps, **sampler_kwargs):
+    """
+    sample num_samples designs for each of a list of configurations in one integration loop
+    every configuration is a dict with a condition `y`, and optionally a guidance weight `gamma`, an `lmbd`
+    and a `seed`; the configurations are packed along the batch dimension as per-sample conditions, guidance
+    weights and lmbds; sample n of every configuration draws its prior and its noise from NoiseBank(seed, n), so
+    configurations with the same seed share their noise (common random numbers) and only differ by their settings
+    a nonzero lmbd needs a sampler with an lmbd argument (not ddim, dpm_solver or the distilled samplers), a
+    ValueError is raised otherwise rather than sampling every lmbd the same way
+    returns one array of final designs of shape (num_samples, dim) per configuration, and the NFE
+    """
+    if not _takes(sampler, 'lmbd') and any(config.get('lmbd', 0.) != 0. for config in configs):
+        raise ValueError("the sampler has no lmbd argument, the lmbds of the configurations would be ignored")
+    device = gen_sde.T.device
+    seeds = []
+    ya, gamma, lmbd = [], [], []
+    for k, config in enumerate(configs):
+        seeds.append(torch.full((num_samples, ), int(config.get('seed', k)), dtype=torch.long))
+        ya.append(torch.ones(num_samples, device=device) * config['y'])
+        gamma.append(torch.ones(num_samples, 1, device=device) * config.get('gamma', 0.))
+        lmbd.append(torch.ones(num_samples, 1, device=device) * config.get('lmbd', 0.))
+    ya = torch.cat(ya)
+    gamma = torch.cat(gamma)
+    lmbd = torch.cat(lmbd)
+    bank = NoiseBank(torch.cat(seeds), torch.arange(num_samples).repeat(len(configs)), device=device)
+
+    x_0 = bank.prior(dim)  # init from prior
+    if _takes(sampler, 'lmbd'):
+        sampler_kwargs['lmbd'] = lmbd
+    if _takes(sampler, 'noise'):
+        sampler_kwargs['noise'] = bank
+    xs, nfe = sampler(gen_sde, x_0, ya, num_steps, gamma=gamma, keep_all_samples=False, **sampler_kwargs)
+    return list(xs[-1].split(num_samples)), nfe
+
+
+@torch.no_grad()
+def stacked_sample(sampler, gen_sde, num_models, num_samples, dim, condition, num_steps, seed=None, **sampler_kwargs):
+    """
+    sample num_samples designs from each of the num_models models of a stacked reverse SDE (nets.stack_gen_sdes)
+    in one integration loop, the designs being interleaved so that design j comes from model j % num_models
+    with a seed, design n of every model draws its prior and noise from NoiseBank(seed, n), like sample_valid does
+    for a single model, so the models share their noise
+    returns the designs as a tensor of shape (num_models, num_samples, dim), and the NFE
+    """
+    device = gen_sde.T.device
+    if seed is not None:
+        bank = NoiseBank(seed, torch.arange(num_samples).repeat_interleave(num_models), device=device)
+        x_0 = bank.prior(dim)  # init from prior
+        if _takes(sampler, 'noise'):
+            sampler_kwargs['noise'] = bank
+    else:
+        x_0 = torch.randn(num_samples * num_models, dim, device=device)  # init from prior
+    ya = torch.ones(num_samples * num_models, device=device) * condition
+    xs, nfe = sampler(gen_sde, x_0, ya, num_steps, keep_all_samples=False, **sampler_kwargs)
+    return xs[-1].view(num_samples, num_models, dim).transpose(0, 1), nfe
+
+
+class WarmStart(object):
+    """
+    SDEdit-style warm start of a fixed grid sampler: every trajectory starts from one of the given designs
+    (e.g. the top designs of the dataset) diffused forward to time t_start with base_sde.sample, and the reverse
+    sampler only integrates from t_start to 0; the prior draw x_0 is used as the forward noise
+    the reverse grid keeps the step size of the full horizon, num_steps * t_start / T steps, so smaller t_start
+    is cheaper and stays closer to the starting designs (exploitation), t_start = T is plain sampling (exploration)
+    with a NoiseBank, design n starts from designs[n % len(designs)], otherwise from a random one
+    called like the wrapped sampler, whose grid and t_stop defaults it keeps; noise and stats are passed on when the
+    wrapped sampler takes them
+    """
+    def __init__(self, sampler, designs, t_start):
+        assert _takes(sampler, 't_stop'), "WarmStart needs a fixed grid sampler"
+        self.sampler = sampler
+        self.designs = designs
+        self.t_start = t_start
+        params = inspect.signature(sampler).parameters
+        self.default_grid = params['grid'].default
+        self.default_t_stop = params['t_stop'].default
+
+    def __call__(self, gen_sde, x_0, ya, num_steps, grid=None, t_stop=None, noise=None, stats=None, **sampler_kwargs):
+        base_sde = gen_sde.base_sde
+        grid = self.default_grid if grid is None else grid
+        t_stop = self.default_t_stop if t_stop is None else t_stop
+        t_stop = base_sde.t_epsilon if t_stop is None else t_stop
+        if isinstance(noise, NoiseBank):
+            index = noise.indices % self.designs.size(0)
+        else:
+            index = torch.randint(self.designs.size(0), (x_0.size(0), ))
+        x_data = self.designs[index.cpu()].to(x_0)
+
+        t = torch.full((x_0.size(0), 1), float(self.t_start), device=x_0.device)
+        x_t = base_sde.sample(t, x_data, epsilon=x_0)
+        num_steps = max(1, int(round(num_steps * self.t_start / float(base_sde.T))))
+        ts = time_grid(base_sde, num_steps, grid=grid, t_stop=t_stop, device=x_0.device, t_start=self.t_start)
+        if noise is not None and _takes(self.sampler, 'noise'):
+            sampler_kwargs['noise'] = noise
+        if stats is not None and _takes(self.sampler, 'stats'):
+            sampler_kwargs['stats'] = stats
+        return self.sampler(gen_sde, x_t, ya, num_steps, grid=ts, **sampler_kwargs)
+
+
+class EulerMaruyamaStep(torch.nn.Module):
+    """
+    one Euler Maruyama step of a reverse SDE on a precomputed schedule, as a module that can be compiled as a whole
+    """
+    def __init__(self, gen_sde, schedule, lmbd=0., gamma=0.):
+        super().__init__()
+        self.gen_sde = gen_sde
+        self.schedule = schedule
+        self.lmbd = lmbd
+        self.gamma = gamma
+
+    def forward(self, x_t, ya, i, z):
+        mu = self.gen_sde.mu_at(self.schedule, i, x_t, ya, lmbd=self.lmbd, gamma=self.gamma)
+        sigma = self.gen_sde.sigma_at(self.schedule, i, lmbd=self.lmbd)
+        return x_t + self.schedule.dt[i] * mu + self.schedule.sqrt_dt[i] * sigma * z
+
+
+class HeunStep(torch.nn.Module):
+    """
+    one stochastic Heun step with first-same-as-last drift reuse (see pc_sampler), as a module that can be
+    compiled as a whole; takes the drift at the start of the step and returns the drift for the next one
+    """
+    def __init__(self, gen_sde, schedule, lmbd=0., gamma=0.):
+        super().__init__()
+        self.gen_sde = gen_sde
+        self.schedule = schedule
+        self.lmbd = lmbd
+        self.gamma = gamma
+
+    def forward(self, x_t, mu, ya, i, z):
+        sigma = self.gen_sde.sigma_at(self.schedule, i, lmbd=self.lmbd)
+        dw = self.schedule.sqrt_dt[i] * z
+        x_pred = x_t + self.schedule.dt[i] * mu + sigma * dw
+        mu_next = self.gen_sde.mu_at(self.schedule, i + 1, x_pred, ya, lmbd=self.lmbd, gamma=self.gamma)
+        sigma_next = self.gen_sde.sigma_at(self.schedule, i + 1, lmbd=self.lmbd)
+        x_t = x_t + 0.5 * self.schedule.dt[i] * (mu + mu_next) + 0.5 * (sigma + sigma_next) * dw
+        return x_t, mu_next
+
+
+def compile_step(step, example_inputs, backend='auto'):
+    """
+    compile a sampler step module: 'jit' traces it into a frozen TorchScript graph, 'compile' uses torch.compile
+    (PyTorch >= 2.0), 'auto' picks torch.compile when it is available and 'none' returns the step unchanged
+    """
+    if backend == 'auto':
+        backend = 'compile' if hasattr(torch, 'compile') else 'jit'
+    if backend == 'none':
+        return step
+    elif backend == 'compile':
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError("torch.compile needs PyTorch >= 2.0, use backend='jit' instead")
+        return torch.compile(step)
+    elif backend == 'jit':
+        traced = torch.jit.trace(step.eval(), example_inputs, check_trace=False)
+        return torch.jit.freeze(traced)
+    else:
+        raise NotImplementedError(f"unknown backend {backend}")
+
+
+def build_compiled_step(gen_sde, schedule, x_t, ya, lmbd=0., gamma=0., predictor='euler', backend='auto'):
+    """
+    the compiled step of compiled_sampler on a schedule, i.e. EulerMaruyamaStep ('euler') or HeunStep ('heun')
+    through compile_step, specialised to the batch of x_t and the conditions ya
+    the step takes (x_t, ya, i, z) or (x_t, mu, ya, i, z) with i a 1-element index tensor into the schedule
+    """
+    assert predictor in ['euler', 'heun'], f"unknown predictor {predictor}"
+    i = torch.zeros(1, dtype=torch.long, device=x_t.device)
+    z = torch.zeros_like(x_t)
+    if predictor == 'heun':
+        return compile_step(HeunStep(gen_sde, schedule, lmbd=lmbd, gamma=gamma), (x_t, z, ya, i, z), backend=backend)
+    return compile_step(EulerMaruyamaStep(gen_sde, schedule, lmbd=lmbd, gamma=gamma), (x_t, ya, i, z), backend=backend)
+
+
+@torch.no_grad()
+def compiled_sampler(gen_sde,
+                     x_0,
+                     ya,
+                     num_steps,
+                     lmbd=0.,
+                     gamma=0.,
+                     predictor='euler',
+                     backend='auto',
+                     grid='uniform',
+                     t_stop=0.,
+                     denoise=False,
+                     keep_all_samples=True,
+                     callback=None,
+                     noise=torch.randn_like):
+    """
+    Euler Maruyama ('euler') or stochastic Heun with drift reuse ('heun') where one full step (drift network,
+    schedule arithmetic and noise injection) is compiled once and reused for all steps, which removes most of the
+    interpreter and dispatch overhead of small networks on CPU
+    the compiled step is specialised to the batch size, the conditions and the guidance weight it was built with,
+    but not to the time grid, whose coefficients it gathers from the schedule; denoise is as in pc_sampler
+    returns the list of kept samples and the number of drift evaluations (NFE)
+    """
+    assert predictor in ['euler', 'heun'], f"unknown predictor {predictor}"
+    # init
+    device = gen_sde.T.device
+    schedule = grid_schedule(gen_sde, num_steps, grid=grid, t_stop=t_stop)
+    # 1-element index tensors, so that the compiled step gathers its coefficients instead of specialising on i
+    steps = torch.arange(num_steps + 1, device=device).view(-1, 1)
+    x_t = x_0.detach().clone().to(device)
+    nfe = 0
+    step = build_compiled_step(gen_sde, schedule, x_t, ya, lmbd=lmbd, gamma=gamma, predictor=predictor,
+                               backend=backend)
+    if predictor == 'heun':
+        mu = gen_sde.mu_at(schedule, 0, x_t, ya, lmbd=lmbd, gamma=gamma)
+        nfe += 1
+
+    # sample
+    xs = []
+    for i in range(num_steps):
+        z = noise(x_t)
+        if predictor == 'euler':
+            x_t = step(x_t, ya, steps[i], z)
+            nfe += 1
+        elif i < num_steps - 1:
+            x_t, mu = step(x_t, mu, ya, steps[i], z)
+            nfe += 1
+        else:
+            # the drift at the end of the last step (t = 0) is never needed
+            sigma = gen_sde.sigma_at(schedule, i, lmbd=lmbd)
+            x_t = x_t + schedule.dt[i] * mu + schedule.sqrt_dt[i] * sigma * z
+
+        if callback is not None:
+            callback(i, x_t)
+        if keep_all_samples or i == num_steps - 1:
+            xs.append(x_t.cpu())
+    if denoise:
+        x_t, nfe = denoise_last(gen_sde, schedule, xs, x_t, ya, nfe, gamma=gamma, callback=callback)
+    return xs, nfe
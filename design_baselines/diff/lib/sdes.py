@@ -3,6 +3,58 @@ from lib.utils import sample_v, log_normal, sample_vp_truncated_q
 import numpy as np
 
 
+def guidance_off(gamma):
+    """
+    True if the guidance weight is zero everywhere (gamma may be a float or a per-sample tensor)
+    """
+    if torch.is_tensor(gamma):
+        return not bool(gamma.ne(0).any())
+    return gamma == 0
+
+
+def guided_drift(a, t, y, ya, gamma=0.):
+    """
+    evaluate the classifier-free guided network output (1 + gamma) a(y, t, ya) - gamma a(y, t, 0)
+    with a single forward pass: the conditional and unconditional inputs are stacked into one 2B batch, or, for a
+    network with separable = True, passed to its forward_conditions
+    t is the forward (diffusion) time, either per sample or a scalar shared by the whole batch
+    """
+    n = y.size(0)
+    t = t.reshape(-1).expand(n)
+    if guidance_off(gamma):
+        return a(y, t, ya)
+    ya = ya.reshape(n, -1)
+    if getattr(a, 'separable', False):
+        # the two branches share the input, so its part of the first layer is computed once
+        a_cond, a_uncond = a.forward_conditions(y, t, [ya, torch.zeros_like(ya)])
+    else:
+        out = a(torch.cat([y, y]), torch.cat([t, t]), torch.cat([ya, torch.zeros_like(ya)]))
+        a_cond, a_uncond = out[:n], out[n:]
+    return a_cond * (1 + gamma) - gamma * a_uncond
+
+
+class SurrogateGuidance(object):
+    """
+    classifier-style guidance by a differentiable surrogate f(x) of the objective, e.g. the MLP of the trained
+    ForwardModel: the score estimate s at (y, t) is shifted by scale * mean_weight(t) * grad f(x0), where
+    x0 = (y + var(t) s) / mean_weight(t) is the Tweedie estimate of the clean design, on which the surrogate was
+    trained; s is held fixed, so this is one vector-Jacobian product through the surrogate only, on the batch of the
+    drift, and the mean_weight(t) factor fades the term out at high noise where x0 carries no information
+    scale may be a float or a per-sample (B, 1) tensor
+    """
+    def __init__(self, model, scale=1.):
+        self.model = model
+        self.scale = scale
+
+    def __call__(self, base_sde, t, y, score):
+        t = t.reshape(-1, 1)
+        alpha = base_sde.mean_weight(t)
+        with torch.enable_grad():
+            x0 = ((y + base_sde.var(t) * score) / alpha).detach().requires_grad_(True)
+            grad, = torch.autograd.grad(self.model(x0).sum(), x0)
+        return self.scale * alpha * grad
+
+
 class VariancePreservingSDE(torch.nn.Module):
     """
     Implementation of the variance preserving SDE proposed by Song et al. 2021
@@ -24,6 +76,25 @@ class VariancePreservingSDE(torch.nn.Module):
     def var(self, t):
         return 1. - torch.exp(-0.5 * t**2 * (self.beta_max-self.beta_min) - t * self.beta_min)
 
+    def log_mean_weight(self, t):
+        return -0.25 * t**2 * (self.beta_max-self.beta_min) - 0.5 * t * self.beta_min
+
+    def marginal_lambda(self, t):
+        """
+        half log signal-to-noise ratio log(mean_weight / std) at time t
+        """
+        log_mean = self.log_mean_weight(t)
+        log_std = 0.5 * torch.log(-torch.expm1(2. * log_mean))
+        return log_mean - log_std
+
+    def inverse_lambda(self, lamb):
+        """
+        time t at which the half log signal-to-noise ratio equals lamb
+        """
+        tmp = 2. * (self.beta_max-self.beta_min) * torch.logaddexp(-2. * lamb, torch.zeros_like(lamb))
+        delta = self.beta_min**2 + tmp
+        return tmp / (torch.sqrt(delta) + self.beta_min) / (self.beta_max-self.beta_min)
+
     def f(self, t, y):
         return - 0.5 * self.beta(t) * y
 
@@ -31,14 +102,15 @@ class VariancePreservingSDE(torch.nn.Module):
         beta_t = self.beta(t)
         return torch.ones_like(y) * beta_t**0.5
 
-    def sample(self, t, y0, return_noise=False):
+    def sample(self, t, y0, return_noise=False, epsilon=None):
         """
-        sample yt | y0
+        sample yt | y0, with the given standard normal epsilon if any
         if return_noise=True, also return std and g for reweighting the denoising score matching loss
         """
         mu = self.mean_weight(t) * y0
         std = self.var(t) ** 0.5
-        epsilon = torch.randn_like(y0)
+        if epsilon is None:
+            epsilon = torch.randn_like(y0)
         yt = epsilon * std + mu
         if not return_noise:
             return yt
@@ -54,6 +126,62 @@ class VariancePreservingSDE(torch.nn.Module):
         return sample_vp_truncated_q(shape, self.beta_min, self.beta_max, t_epsilon=self.t_epsilon, T=self.T)
 
 
+def time_grid(base_sde, num_steps, grid='uniform', t_stop=0., rho=7., device=None, t_start=None):
+    """
+    reverse-time grid 0 = ts[0] < ... < ts[num_steps] = T - t_stop for a fixed step sampler
+    with t_start, the grid starts at forward time t_start instead of T, i.e. ts[0] = T - t_start (warm start)
+    'uniform' is uniform in t, 'quadratic' is uniform in sqrt(t), 'edm' is the rho-spacing of Karras et al. 2022
+    on sigma = std / mean_weight, 'logsnr' is uniform in the half log-SNR lambda (DPM-Solver); the last three
+    put more steps at low noise, where the designs form
+    'edm' and 'logsnr' need t_stop > 0 since lambda diverges at t = 0, t_epsilon is used otherwise
+    """
+    T_ = float(base_sde.T)
+    t_start = T_ if t_start is None else float(t_start)
+    assert t_stop < t_start <= T_, f"need t_stop < t_start <= T, got t_stop={t_stop}, t_start={t_start}"
+    if grid in ['edm', 'logsnr'] and t_stop <= 0:
+        t_stop = base_sde.t_epsilon
+    u = torch.linspace(0., 1., num_steps + 1, dtype=torch.float64)
+    # forward times, from t_start down to t_stop
+    if grid == 'uniform':
+        t = t_start + (t_stop - t_start) * u
+    elif grid == 'quadratic':
+        t = t_stop + (t_start - t_stop) * (1. - u)**2
+    elif grid in ['edm', 'logsnr']:
+        ends = torch.tensor([t_start, t_stop], dtype=torch.float64)
+        lamb_max, lamb_min = base_sde.marginal_lambda(ends).tolist()
+        if grid == 'edm':
+            sigma_max, sigma_min = np.exp(-lamb_max), np.exp(-lamb_min)
+            sigma = (sigma_max**(1 / rho) + u * (sigma_min**(1 / rho) - sigma_max**(1 / rho)))**rho
+            lamb = -torch.log(sigma)
+        else:
+            lamb = lamb_max + u * (lamb_min - lamb_max)
+        t = base_sde.inverse_lambda(lamb)
+        # pin the end points, inverse_lambda is only exact up to rounding
+        t[0], t[-1] = t_start, t_stop
+    else:
+        raise NotImplementedError(f"unknown time grid {grid}")
+    return (T_ - t).to(dtype=torch.float32, device=device)
+
+
+class SamplingSchedule(object):
+    """
+    coefficients of a VP SDE on a fixed grid of reverse times ts (0 <= ts <= T), computed once
+    as tensors on the grid's device so that samplers only have to index them at every step
+    """
+    def __init__(self, base_sde, ts):
+        self.ts = ts
+        self.num_steps = ts.size(0) - 1
+        # forward (diffusion) time of each grid point
+        self.t_fwd = base_sde.T - ts
+        self.beta = base_sde.beta(self.t_fwd)
+        self.g = self.beta ** 0.5
+        self.log_alpha = base_sde.log_mean_weight(self.t_fwd)
+        self.alpha = torch.exp(self.log_alpha)
+        self.std = base_sde.var(self.t_fwd) ** 0.5
+        self.dt = ts[1:] - ts[:-1]
+        self.sqrt_dt = self.dt.abs() ** 0.5
+
+
 class ScorePluginReverseSDE(torch.nn.Module):
     """
     inverting a given base sde with drift `f` and diffusion `g`, and an inference sde's drift `a` by
@@ -69,17 +197,51 @@ class ScorePluginReverseSDE(torch.nn.Module):
         self.T = T
         self.vtype = vtype
         self.debias = debias
+        self.surrogate = None
+
+    def guided_a(self, t, y, ya, gamma=0.):
+        """
+        classifier-free guided network output (1 + gamma) a(y, t, ya) - gamma a(y, t, 0)
+        the conditional and unconditional branches share one forward pass over a stacked 2B batch,
+        and the unconditional branch is skipped altogether when gamma == 0
+        with a SurrogateGuidance in self.surrogate, its score shift is added
+        """
+        a = guided_drift(self.a, t, y, ya, gamma)
+        if self.surrogate is not None:
+            a = a + self.surrogate(self.base_sde, t, y, a)
+        return a
 
     # Drift
     def mu(self, t, y, ya, lmbd=0., gamma=0.):
-        a = self.a(y, self.T - t.squeeze(), ya) * (1 + gamma) - gamma * self.a(y, self.T - t.squeeze(), torch.zeros_like(ya))
+        a = self.guided_a(self.T - t, y, ya, gamma=gamma)
         return (1. - 0.5 * lmbd) * (self.base_sde.g(self.T-t, y) ** 2) *  a - \
                self.base_sde.f(self.T - t, y)
 
+    def mu_at(self, schedule, i, y, ya, lmbd=0., gamma=0.):
+        """
+        drift at the i-th time of a precomputed SamplingSchedule
+        """
+        a = self.guided_a(schedule.t_fwd[i], y, ya, gamma=gamma)
+        return (1. - 0.5 * lmbd) * schedule.beta[i] * a + 0.5 * schedule.beta[i] * y
+
     # Diffusion
     def sigma(self, t, y, lmbd=0.):
         return (1. - lmbd) ** 0.5 * self.base_sde.g(self.T-t, y)
 
+    def sigma_at(self, schedule, i, lmbd=0.):
+        return (1. - lmbd) ** 0.5 * schedule.g[i]
+
+    def epsilon(self, t, y, ya, gamma=0.):
+        """
+        noise prediction implied by the (guided) score estimate, eps = - std * score
+        unlike mu and sigma, t is the forward (diffusion) time
+        """
+        std = self.base_sde.var(t) ** 0.5
+        return - std * self.guided_a(t, y, ya, gamma=gamma)
+
+    def epsilon_at(self, schedule, i, y, ya, gamma=0.):
+        return - schedule.std[i] * self.guided_a(schedule.t_fwd[i], y, ya, gamma=gamma)
+
     @torch.enable_grad()
     def dsm(self, x, y):
         """
@@ -158,17 +320,52 @@ class PluginReverseSDE(torch.nn.Module):
         self.T = T
         self.vtype = vtype
         self.debias = debias
+        self.surrogate = None
+
+    def guided_a(self, t, y, ya, gamma=0.):
+        """
+        classifier-free guided network output (1 + gamma) a(y, t, ya) - gamma a(y, t, 0)
+        the conditional and unconditional branches share one forward pass over a stacked 2B batch,
+        and the unconditional branch is skipped altogether when gamma == 0
+        with a SurrogateGuidance in self.surrogate, its score shift (times g, as a = g * score) is added
+        """
+        a = guided_drift(self.a, t, y, ya, gamma)
+        if self.surrogate is not None:
+            g = self.base_sde.beta(t.reshape(-1, 1)) ** 0.5
+            a = a + g * self.surrogate(self.base_sde, t, y, a / g)
+        return a
 
     # Drift
     def mu(self, t, y, ya, lmbd=0., gamma=0.):
-        a = self.a(y, self.T - t.squeeze(), ya) * (1 + gamma) - gamma * self.a(y, self.T - t.squeeze(), torch.zeros_like(ya))
+        a = self.guided_a(self.T - t, y, ya, gamma=gamma)
         return (1. - 0.5 * lmbd) * self.base_sde.g(self.T-t, y) * a - \
                self.base_sde.f(self.T - t, y)
 
+    def mu_at(self, schedule, i, y, ya, lmbd=0., gamma=0.):
+        """
+        drift at the i-th time of a precomputed SamplingSchedule
+        """
+        a = self.guided_a(schedule.t_fwd[i], y, ya, gamma=gamma)
+        return (1. - 0.5 * lmbd) * schedule.g[i] * a + 0.5 * schedule.beta[i] * y
+
     # Diffusion
     def sigma(self, t, y, lmbd=0.):
         return (1. - lmbd) ** 0.5 * self.base_sde.g(self.T-t, y)
 
+    def sigma_at(self, schedule, i, lmbd=0.):
+        return (1. - lmbd) ** 0.5 * schedule.g[i]
+
+    def epsilon(self, t, y, ya, gamma=0.):
+        """
+        noise prediction implied by the (guided) drift estimate a = g * score, eps = - std * a / g
+        unlike mu and sigma, t is the forward (diffusion) time
+        """
+        std = self.base_sde.var(t) ** 0.5
+        return - std / self.base_sde.beta(t) ** 0.5 * self.guided_a(t, y, ya, gamma=gamma)
+
+    def epsilon_at(self, schedule, i, y, ya, gamma=0.):
+        return - schedule.std[i] / schedule.g[i] * self.guided_a(schedule.t_fwd[i], y, ya, gamma=gamma)
+
     @torch.enable_grad()
     def dsm(self, x, y):
         """
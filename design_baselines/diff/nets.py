@@ -18,18 +18,22 @@ def suppress_output():
 
 
 with suppress_output():
-    import design_bench
-
-    from design_bench.datasets.discrete.tf_bind_8_dataset import TFBind8Dataset
-    from design_bench.datasets.discrete.tf_bind_10_dataset import TFBind10Dataset
-    from design_bench.datasets.discrete.cifar_nas_dataset import CIFARNASDataset
-    from design_bench.datasets.discrete.chembl_dataset import ChEMBLDataset
-    from design_bench.datasets.discrete.gfp_dataset import GFPDataset
-
-    from design_bench.datasets.continuous.ant_morphology_dataset import AntMorphologyDataset
-    from design_bench.datasets.continuous.dkitty_morphology_dataset import DKittyMorphologyDataset
-    from design_bench.datasets.continuous.superconductor_dataset import SuperconductorDataset
-    from design_bench.datasets.continuous.hopper_controller_dataset import HopperControllerDataset
+    try:
+        import design_bench
+
+        from design_bench.datasets.discrete.tf_bind_8_dataset import TFBind8Dataset
+        from design_bench.datasets.discrete.tf_bind_10_dataset import TFBind10Dataset
+        from design_bench.datasets.discrete.cifar_nas_dataset import CIFARNASDataset
+        from design_bench.datasets.discrete.chembl_dataset import ChEMBLDataset
+        from design_bench.datasets.discrete.gfp_dataset import GFPDataset
+
+        from design_bench.datasets.continuous.ant_morphology_dataset import AntMorphologyDataset
+        from design_bench.datasets.continuous.dkitty_morphology_dataset import DKittyMorphologyDataset
+        from design_bench.datasets.continuous.superconductor_dataset import SuperconductorDataset
+        from design_bench.datasets.continuous.hopper_controller_dataset import HopperControllerDataset
+    except ImportError:
+        # only needed for the design-bench tasks, the Branin stand-in (bench_samplers.py) runs without it
+        design_bench = None
 
 import numpy as np
 import pytorch_lightning as pl
@@ -108,6 +112,8 @@ class MLP(nn.Module):
         self.hidden_dim = hidden_dim
         self.act = act
         self.y_dim = 1
+        # inference only: evaluate several conditions of the same input with forward_conditions (see guided_drift)
+        self.separable = False
         self.main = nn.Sequential(
             nn.Linear(input_dim + index_dim + self.y_dim, hidden_dim),
             act,
@@ -144,6 +150,79 @@ class MLP(nn.Module):
         output = self.main(h)  # forward
         return output.view(*sz)
 
+    def forward_conditions(self, input, t, ys):
+        """
+        the outputs for each condition in ys at the same input and time, in one batch; the first layer is split
+        as W_x input + W_t t + W_y y, so that W_x input + W_t t is computed once for all conditions and each
+        condition only adds its rank-1 W_y y term; equal to [self(input, t, y) for y in ys] up to rounding
+        """
+        # init
+        sz = input.size()
+        input = input.view(-1, self.input_dim)
+        t = t.view(-1, self.index_dim).float()
+
+        # forward
+        first = self.main[0]
+        w_x, w_t, w_y = first.weight.split([self.input_dim, self.index_dim, self.y_dim], dim=1)
+        h = torch.addmm(first.bias, input, w_x.t()) + t @ w_t.t()
+        h = torch.cat([h + y.view(-1, self.y_dim).float() * w_y.view(1, -1) for y in ys])
+        output = self.main[1:](h)
+        return [out.view(*sz) for out in output.split(input.size(0))]
+
+
+class StackedMLP(nn.Module):
+    """
+    K MLPs of the same architecture (e.g. the checkpoints of several seeds) evaluated as one: the weights of every
+    Linear layer are stacked along a leading model dimension and each layer is a single baddbmm over the K models
+    sample j of a batch goes through model j % K, so that a batch stacked on itself (the two branches of
+    classifier-free guidance) keeps every sample on its own model; the batch size must be a multiple of K
+    """
+
+    def __init__(self, mlps):
+        super().__init__()
+        self.num_models = len(mlps)
+        self.input_dim = mlps[0].input_dim
+        self.index_dim = mlps[0].index_dim
+        self.y_dim = mlps[0].y_dim
+        self.layers = []
+        for k, layers in enumerate(zip(*[mlp.main for mlp in mlps])):
+            if isinstance(layers[0], nn.Linear):
+                weight = torch.stack([layer.weight.detach().t() for layer in layers])
+                bias = torch.stack([layer.bias.detach() for layer in layers]).unsqueeze(1)
+                self.register_buffer(f"weight_{k}", weight)
+                self.register_buffer(f"bias_{k}", bias)
+                self.layers.append(k)
+            else:
+                assert not list(layers[0].parameters()), "only the Linear layers may have parameters"
+                self.layers.append(layers[0])
+
+    def forward(self, input, t, y):
+        # init
+        sz = input.size()
+        input = input.view(-1, self.input_dim)
+        t = t.view(-1, self.index_dim).float()
+        y = y.view(-1, self.y_dim).float()
+
+        # forward, with the samples of model k in h[k]
+        h = torch.cat([input, t, y], dim=1)  # concat
+        h = h.view(-1, self.num_models, h.size(1)).transpose(0, 1)
+        for layer in self.layers:
+            if isinstance(layer, int):
+                h = torch.baddbmm(getattr(self, f"bias_{layer}"), h, getattr(self, f"weight_{layer}"))
+            else:
+                h = layer(h)
+        return h.transpose(0, 1).reshape(*sz)
+
+
+def stack_gen_sdes(gen_sdes):
+    """
+    one reverse SDE sampling from K trained reverse SDEs of the same type, base SDE and MLP architecture at once,
+    design j being sampled from model j % K (see StackedMLP)
+    """
+    ref = gen_sdes[0]
+    drift = StackedMLP([gen_sde.a for gen_sde in gen_sdes]).to(ref.T.device)
+    return type(ref)(ref.base_sde, drift, ref.T, vtype=ref.vtype, debias=ref.debias)
+
 
 class DiffusionTest(pl.LightningModule):
 
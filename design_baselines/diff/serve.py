@@ -0,0 +1,226 @@
+"""
+Long-lived design generation server: the DDOM checkpoints are loaded once (see run_serve in trainer.py) and
+concurrent requests are coalesced into shared sampler batches.
+
+    POST /sample  {"task": "dkitty", "num_samples": 64, "condition": 1.0, "gamma": 2.0, "seed": 0}
+                  -> newline delimited JSON, one {"designs": [...]} line per batch of at most max_batch designs
+    GET  /tasks   -> {"dkitty": {"shape": [56], "condition": ...}, ...}
+
+condition defaults to the task's default (the dataset max), gamma to the server's --gamma and seed to a random one;
+a seeded request returns the same designs whatever it is batched with (see NoiseBank)
+
+Stand-in client:
+
+    python design_baselines/diff/serve.py --url http://127.0.0.1:8000 --task dkitty --num_samples 64
+"""
+
+import argparse
+import inspect
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request as urlrequest
+
+import numpy as np
+import torch
+
+from lib.samplers import NoiseBank
+
+
+class _Job(object):
+    """
+    num_samples designs of one request, designs start to start + num_samples of its noise stream
+    """
+    def __init__(self, task, num_samples, condition, gamma, seed, start):
+        self.task = task
+        self.num_samples = num_samples
+        self.condition = condition
+        self.gamma = gamma
+        self.seed = seed
+        self.start = start
+        self.future = Future()
+
+
+class DesignServer(object):
+    """
+    models maps a task name to dict(gen_sde=..., shape=..., condition=...) where shape is the shape of one design
+    and condition the default condition; sampler is a fixed grid sampler called with per-sample conditions and
+    guidance weights, sampler_kwargs must not contain gamma
+    a single worker thread runs the sampler: it takes the oldest pending job and adds the pending jobs of the same
+    task until max_batch designs are collected or max_wait seconds have passed
+    """
+    def __init__(self, models, sampler, sampler_kwargs, num_steps, max_batch=1024, max_wait=0.01, default_gamma=0.):
+        self.models = models
+        self.sampler = sampler
+        self.sampler_kwargs = sampler_kwargs
+        self.num_steps = num_steps
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.default_gamma = default_gamma
+        self.takes_noise = 'noise' in inspect.signature(sampler).parameters
+        self.queue = queue.Queue()
+        self.pending = []
+        self.num_batches = 0
+        self.worker = threading.Thread(target=self._loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, task, num_samples, condition=None, gamma=None, seed=None):
+        """
+        queue a request, split into jobs of at most max_batch designs; returns one future per job, in order
+        """
+        if task not in self.models:
+            raise KeyError(f"task {task} is not served, available: {sorted(self.models)}")
+        condition = self.models[task]['condition'] if condition is None else condition
+        gamma = self.default_gamma if gamma is None else gamma
+        seed = int(np.random.randint(2**31 - 1)) if seed is None else int(seed)
+        jobs = [
+            _Job(task, min(self.max_batch, num_samples - start), float(condition), float(gamma), seed, start)
+            for start in range(0, num_samples, self.max_batch)
+        ]
+        for job in jobs:
+            self.queue.put(job)
+        return [job.future for job in jobs]
+
+    def _next_batch(self):
+        if not self.pending:
+            self.pending.append(self.queue.get())
+        task = self.pending[0].task
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or sum(job.num_samples for job in self.pending if job.task == task) >= self.max_batch:
+                break
+            try:
+                self.pending.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        batch, size = [], 0
+        for job in self.pending:
+            if job.task == task and size + job.num_samples <= self.max_batch:
+                batch.append(job)
+                size += job.num_samples
+        self.pending = [job for job in self.pending if job not in batch]
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                designs = self._sample(batch)
+            except Exception as e:
+                for job in batch:
+                    job.future.set_exception(e)
+            else:
+                for job, x in zip(batch, designs):
+                    job.future.set_result(x)
+
+    @torch.no_grad()
+    def _sample(self, batch):
+        model = self.models[batch[0].task]
+        gen_sde = model['gen_sde']
+        device = gen_sde.T.device
+        dim = int(np.prod(model['shape']))
+        sizes = [job.num_samples for job in batch]
+        ya = torch.cat([torch.full((job.num_samples, ), job.condition) for job in batch]).to(device)
+        gamma = torch.cat([torch.full((job.num_samples, 1), job.gamma) for job in batch]).to(device)
+        bank = NoiseBank(torch.cat([torch.full((job.num_samples, ), job.seed, dtype=torch.long) for job in batch]),
+                         torch.cat([torch.arange(job.start, job.start + job.num_samples) for job in batch]),
+                         device=device)
+        x_0 = bank.prior(dim)  # init from prior
+        sampler_kwargs = dict(self.sampler_kwargs, noise=bank) if self.takes_noise else self.sampler_kwargs
+        xs, _ = self.sampler(gen_sde, x_0, ya, self.num_steps, gamma=gamma, keep_all_samples=False, **sampler_kwargs)
+        self.num_batches += 1
+        return [x.view(-1, *model['shape']).numpy() for x in xs[-1].split(sizes)]
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send_json(self, code, obj):
+                body = json.dumps(obj).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != '/tasks':
+                    return self._send_json(404, dict(error=f"unknown path {self.path}"))
+                self._send_json(
+                    200, {
+                        task: dict(shape=list(model['shape']), condition=float(model['condition']))
+                        for task, model in server.models.items()
+                    })
+
+            def do_POST(self):
+                if self.path != '/sample':
+                    return self._send_json(404, dict(error=f"unknown path {self.path}"))
+                try:
+                    req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                    futures = server.submit(req['task'],
+                                            int(req['num_samples']),
+                                            condition=req.get('condition'),
+                                            gamma=req.get('gamma'),
+                                            seed=req.get('seed'))
+                except (KeyError, ValueError) as e:
+                    return self._send_json(400, dict(error=str(e)))
+                # the response is closed by the server, so each batch is written as soon as it is sampled
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                for future in futures:
+                    try:
+                        line = dict(designs=future.result().tolist())
+                    except Exception as e:
+                        line = dict(error=repr(e))
+                    self.wfile.write((json.dumps(line) + '\n').encode())
+                    self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve_forever(self, host='127.0.0.1', port=8000):
+        httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        print(f"serving {sorted(self.models)} on http://{host}:{httpd.server_port}")
+        httpd.serve_forever()
+
+
+def iter_designs(url, task, num_samples, condition=None, gamma=None, seed=None, timeout=None):
+    """
+    stand-in client: yield the designs of one request batch by batch as the server streams them
+    """
+    req = dict(task=task, num_samples=num_samples, condition=condition, gamma=gamma, seed=seed)
+    req = urlrequest.Request(url.rstrip('/') + '/sample',
+                             data=json.dumps({k: v for k, v in req.items() if v is not None}).encode(),
+                             headers={'Content-Type': 'application/json'})
+    with urlrequest.urlopen(req, timeout=timeout) as response:
+        for line in response:
+            out = json.loads(line)
+            if 'error' in out:
+                raise RuntimeError(out['error'])
+            yield np.array(out['designs'], dtype=np.float32)
+
+
+def request_designs(url, task, num_samples, condition=None, gamma=None, seed=None, timeout=None):
+    return np.concatenate(list(iter_designs(url, task, num_samples, condition, gamma, seed, timeout)), axis=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--task', type=str, required=True)
+    parser.add_argument('--num_samples', type=int, default=64)
+    parser.add_argument('--condition', type=float, default=None)
+    parser.add_argument('--gamma', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for x in iter_designs(args.url, args.task, args.num_samples, args.condition, args.gamma, args.seed):
+        print(f"{time.perf_counter() - start:8.3f}s: {x.shape[0]} designs of shape {x.shape[1:]}")
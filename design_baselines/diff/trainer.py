@@ -4,6 +4,7 @@ import random
 import string
 import uuid
 import shutil
+import time
 
 from typing import Optional, Union
 from pprint import pprint
@@ -46,9 +47,16 @@ import pickle as pkl
 import torch
 from torch.utils.data import Dataset, DataLoader
 
-from nets import DiffusionTest, DiffusionScore
-from util import TASKNAME2TASK, configure_gpu, set_seed, get_weights
+from nets import DiffusionTest, DiffusionScore, stack_gen_sdes
+from util import TASKNAME2TASK, configure_gpu, set_seed, get_weights, OracleCache
 from forward import ForwardModel
+from serve import DesignServer
+from distill import DistilledStudent, distilled_sampler, progressive_distillation
+from distill import ConsistencyModel, consistency_sampler, consistency_distillation
+from lib.samplers import heun_sampler, euler_maruyama_sampler, pc_sampler, ode_sampler, dpm_solver_sampler, ddim_sampler
+from lib.samplers import stream_samples, grid_sample, compiled_sampler, sample_valid, NoiseBank
+from lib.samplers import sharded_sample, tune_shards, WarmStart, elbo_scores, stacked_sample, picard_sampler
+from lib.sdes import SurrogateGuidance
 
 args_filename = "args.json"
 checkpoint_dir = "checkpoints"
@@ -442,20 +450,8 @@ def run_training(
     trainer.fit(model, data_module)
 
 
-@torch.no_grad()
-def run_evaluate(
-    taskname,
-    seed,
-    hidden_size,
-    learning_rate,
-    checkpoint_path,
-    args,
-    wandb_logger=None,
-    device=None,
-    normalise_x=False,
-    normalise_y=False,
-):
-    set_seed(seed)
+def load_task(taskname, normalise_x=False, normalise_y=False):
+    """Make the design-bench task of a sampling mode (normalised, logits if discrete) and its design dimension."""
     task = design_bench.make(TASKNAME2TASK[taskname])
     if normalise_x:
         task.map_normalize_x()
@@ -464,7 +460,14 @@ def run_evaluate(
 
     if task.is_discrete:
         task.map_to_logits()
+        dim = task.x.shape[-1] * task.x.shape[-2]
+    else:
+        dim = task.x.shape[-1]
+    return task, dim
 
+
+def load_diffusion_model(checkpoint_path, taskname, task, args, device=None):
+    """Load a trained DiffusionTest (or DiffusionScore) checkpoint for sampling."""
     if not args.score_matching:
         model = DiffusionTest.load_from_checkpoint(
             checkpoint_path=checkpoint_path,
@@ -493,84 +496,107 @@ def run_evaluate(
 
     model = model.to(device)
     model.eval()
+    return model
+
+
+def load_sampling_model(checkpoint_path, taskname, task, args, device=None):
+    """Reverse SDE to sample from and its number of steps: the DDOM checkpoint, or a distilled student."""
+    if args.sampler == 'distilled':
+        student_path = os.path.join(f"./experiments/{taskname}/{args.name}/{args.seed}", "distilled",
+                                    f"student_{args.student_steps}.pt")
+        student = DistilledStudent.load(student_path, device=device)
+        return student, student.num_steps
+    if args.sampler == 'consistency':
+        model = ConsistencyModel.load(os.path.join(f"./experiments/{taskname}/{args.name}/{args.seed}", "distilled",
+                                                   "consistency.pt"),
+                                      device=device)
+        return model, args.consistency_sample_steps
+    model = load_diffusion_model(checkpoint_path, taskname, task, args, device)
+    if args.separable_first_layer:
+        model.gen_sde.a.separable = True
+    return model.gen_sde, args.num_steps
+
+
+# samplers of distilled models, which have their own fixed time grid
+DISTILLED_SAMPLERS = ['distilled', 'consistency']
+
+
+def get_sampler(args, lmbd=0.):
+    """Map --sampler to one of the fixed grid samplers and its keyword arguments."""
+    fn, kwargs = _get_sampler(args, lmbd)
+    if args.sampler in DISTILLED_SAMPLERS:
+        return fn, kwargs
+    if args.time_grid is not None:
+        kwargs['grid'] = args.time_grid
+    if args.t_stop is not None:
+        kwargs['t_stop'] = args.t_stop
+    if args.denoise:
+        kwargs['denoise'] = True
+    return fn, kwargs
+
+
+def _get_sampler(args, lmbd=0.):
+    if args.compile_backend != 'none' and (args.sampler == 'euler_maruyama' or
+                                           (args.sampler == 'heun' and args.fsal)):
+        predictor = 'euler' if args.sampler == 'euler_maruyama' else 'heun'
+        return compiled_sampler, dict(lmbd=lmbd, gamma=args.gamma, predictor=predictor, backend=args.compile_backend)
+    elif args.sampler == 'heun':
+        return heun_sampler, dict(lmbd=lmbd, gamma=args.gamma, fsal=args.fsal)
+    elif args.sampler == 'euler_maruyama':
+        return euler_maruyama_sampler, dict(lmbd=lmbd, gamma=args.gamma)
+    elif args.sampler == 'pc':
+        return pc_sampler, dict(lmbd=lmbd,
+                                gamma=args.gamma,
+                                predictor=args.predictor,
+                                n_corrector=args.n_corrector,
+                                snr=args.snr,
+                                fsal=args.fsal)
+    elif args.sampler == 'dpm_solver':
+        return dpm_solver_sampler, dict(order=args.solver_order, gamma=args.gamma)
+    elif args.sampler == 'ddim':
+        return ddim_sampler, dict(eta=args.eta, gamma=args.gamma)
+    elif args.sampler == 'picard':
+        return picard_sampler, dict(lmbd=lmbd, gamma=args.gamma, window=args.picard_window, tol=args.picard_tol)
+    elif args.sampler == 'distilled':
+        return distilled_sampler, dict(gamma=args.gamma)
+    elif args.sampler == 'consistency':
+        return consistency_sampler, dict(gamma=args.gamma)
+    else:
+        raise NotImplementedError(f"{args.sampler} is not a fixed grid sampler")
 
-    def heun_sampler(sde, x_0, ya, num_steps, lmbd=0., keep_all_samples=True):
-        device = sde.gen_sde.T.device
-        batch_size = x_0.size(0)
-        ndim = x_0.dim() - 1
-        T_ = sde.gen_sde.T.cpu().item()
-        delta = T_ / num_steps
-        ts = torch.linspace(0, 1, num_steps + 1) * T_
-
-        # sample
-        xs = []
-        x_t = x_0.detach().clone().to(device)
-        t = torch.zeros(batch_size, *([1] * ndim), device=device)
-        t_n = torch.zeros(batch_size, *([1] * ndim), device=device)
-        with torch.no_grad():
-            for i in range(num_steps):
-                t.fill_(ts[i].item())
-                if i < num_steps - 1:
-                    t_n.fill_(ts[i + 1].item())
-                mu = sde.gen_sde.mu(t, x_t, ya, lmbd=lmbd, gamma=args.gamma)
-                sigma = sde.gen_sde.sigma(t, x_t, lmbd=lmbd)
-                x_t = x_t + delta * mu + delta**0.5 * sigma * torch.randn_like(
-                    x_t
-                )  # one step update of Euler Maruyama method with a step size delta
-                # Additional terms for Heun's method
-                if i < num_steps - 1:
-                    mu2 = sde.gen_sde.mu(t_n,
-                                         x_t,
-                                         ya,
-                                         lmbd=lmbd,
-                                         gamma=args.gamma)
-                    sigma2 = sde.gen_sde.sigma(t_n, x_t, lmbd=lmbd)
-                    x_t = x_t + (sigma2 -
-                                 sigma) / 2 * delta**0.5 * torch.randn_like(x_t)
-
-                if keep_all_samples or i == num_steps - 1:
-                    xs.append(x_t.cpu())
-                else:
-                    pass
-        return xs
-
-    def euler_maruyama_sampler(sde,
-                               x_0,
-                               ya,
-                               num_steps,
-                               lmbd=0.,
-                               keep_all_samples=True):
-        """
-        Euler Maruyama method with a step size delta
-        """
-        # init
-        device = sde.gen_sde.T.device
-        batch_size = x_0.size(0)
-        ndim = x_0.dim() - 1
-        T_ = sde.gen_sde.T.cpu().item()
-        delta = T_ / num_steps
-        ts = torch.linspace(0, 1, num_steps + 1) * T_
-
-        # sample
-        xs = []
-        x_t = x_0.detach().clone().to(device)
-        t = torch.zeros(batch_size, *([1] * ndim), device=device)
-        with torch.no_grad():
-            for i in range(num_steps):
-                t.fill_(ts[i].item())
-                mu = sde.gen_sde.mu(t, x_t, ya, lmbd=lmbd, gamma=args.gamma)
-                sigma = sde.gen_sde.sigma(t, x_t, lmbd=lmbd)
-                x_t = x_t + delta * mu + delta**0.5 * sigma * torch.randn_like(
-                    x_t
-                )  # one step update of Euler Maruyama method with a step size delta
-                if keep_all_samples or i == num_steps - 1:
-                    xs.append(x_t.cpu())
-                else:
-                    pass
-        return xs
 
-    num_steps = args.num_steps
-    num_samples = 512
+@torch.no_grad()
+def top_designs(task, k):
+    """
+    the k highest scoring designs of the dataset, flattened as the generative model sees them (logits if discrete)
+    """
+    x = task.x.reshape(task.x.shape[0], -1)
+    top = np.argsort(task.y.reshape(-1))[-k:]
+    return torch.tensor(x[top], dtype=torch.float32)
+
+
+@torch.no_grad()
+def run_evaluate(
+    taskname,
+    seed,
+    hidden_size,
+    learning_rate,
+    checkpoint_path,
+    args,
+    wandb_logger=None,
+    device=None,
+    normalise_x=False,
+    normalise_y=False,
+):
+    set_seed(seed)
+    task, dim = load_task(taskname, normalise_x, normalise_y)
+
+    gen_sde, num_steps = load_sampling_model(checkpoint_path, taskname, task, args, device)
+    if args.elbo_keep_frac is not None:
+        assert hasattr(gen_sde, 'elbo_random_t_slice'), \
+            "the ELBO pre-filter needs a DDOM reverse SDE, not a distilled model"
+
+    num_samples = args.num_samples
     # num_samples = 10
 
     # lmbds = [0., 1.]
@@ -598,6 +624,36 @@ def run_evaluate(
         os.unlink(symlink_dir)
     os.symlink(run_specific_str, symlink_dir)
 
+    if args.stream_samples > 0:
+        # bounded memory sampling of a large candidate pool, scored separately
+        sampler, sampler_kwargs = get_sampler(args, lmbd=lmbds[0])
+        traj_path = os.path.join(save_results_dir, 'trajectories.npy')
+        traj, steps, nfe = stream_samples(sampler,
+                                          gen_sde,
+                                          traj_path,
+                                          args.stream_samples,
+                                          dim,
+                                          args.condition,
+                                          num_steps,
+                                          snapshot_stride=args.snapshot_stride,
+                                          snapshot_steps=args.snapshot_steps,
+                                          chunk_size=args.chunk_size,
+                                          seed=args.noise_seed,
+                                          **sampler_kwargs)
+        print("Wrote steps {} of {} samples to {}".format(steps, traj.shape[1], traj_path))
+        print("NFE: {}".format(nfe))
+        if args.elbo_keep_frac is not None:
+            # in-distribution scores of the final designs, and the indices that pass the pre-filter
+            elbo, elbo_var = elbo_scores(gen_sde, traj[-1], num_probes=args.elbo_probes, chunk_size=args.chunk_size)
+            keep = np.sort(np.argsort(-elbo)[:max(1, int(round(args.elbo_keep_frac * len(elbo))))])
+            np.save(os.path.join(save_results_dir, 'elbo.npy'), elbo)
+            np.save(os.path.join(save_results_dir, 'elbo_var.npy'), elbo_var)
+            np.save(os.path.join(save_results_dir, 'elbo_keep.npy'), keep)
+            print("ELBO filter: kept {} of {} designs, probe std {:.4f}, std of the mean {:.4f}".format(
+                len(keep), len(elbo), np.sqrt(elbo_var.mean()), np.sqrt(elbo_var.mean() / args.elbo_probes)))
+        shutil.copy(args.configs, save_results_dir)
+        return
+
     @torch.no_grad()
     def _get_trained_model():
         checkpoint_path = f"experiments/{taskname}/forward_model/123/wandb/latest-run/files/checkpoints/last.ckpt"
@@ -608,27 +664,81 @@ def run_evaluate(
 
         return model
 
+    if args.surrogate_scale > 0:
+        # add the gradient of the forward model's prediction to the reverse drift
+        assert hasattr(gen_sde, 'surrogate'), "surrogate guidance needs a DDOM reverse SDE, not a distilled model"
+        gen_sde.surrogate = SurrogateGuidance(_get_trained_model().mlp.to(device).eval(), args.surrogate_scale)
+
     # sample and plot
     designs = []
     results = []
+    # discrete designs are decoded and only new sequences are sent to the oracle
+    oracle = OracleCache(task.predict) if task.is_discrete else None
     for lmbd in lmbds:
-        if not task.is_discrete:
-            x_0 = torch.randn(num_samples, task.x.shape[-1],
-                              device=device)  # init from prior
+        start = time.perf_counter()
+        if args.sampler == 'ode':
+            if args.noise_seed is not None:
+                x_0 = NoiseBank(args.noise_seed, torch.arange(num_samples), device=device).prior(dim)
+            else:
+                x_0 = torch.randn(num_samples, dim, device=device)  # init from prior
+            y_ = torch.ones(num_samples).to(device) * args.condition
+            xs, nfe = ode_sampler(gen_sde,
+                                  x_0,
+                                  y_,
+                                  gamma=args.gamma,
+                                  rtol=args.ode_rtol,
+                                  atol=args.ode_atol,
+                                  keep_all_samples=False)  # sample
+            print("NFE: {}".format(nfe))
         else:
-            x_0 = torch.randn(num_samples,
-                              task.x.shape[-1] * task.x.shape[-2],
-                              device=device)  # init from prior
-
-        y_ = torch.ones(num_samples).to(device) * args.condition
-        # xs = euler_maruyama_sampler(model,
-        xs = heun_sampler(model,
-                          x_0,
-                          y_,
-                          num_steps,
-                          lmbd=lmbd,
-                          keep_all_samples=False)  # sample
-                          # keep_all_samples=True)  # sample
+            # failed trajectories are resampled instead of dropping the whole batch
+            sampler, sampler_kwargs = get_sampler(args, lmbd=lmbd)
+            if args.warm_start_t is not None:
+                # start from the top designs diffused to warm_start_t instead of from the prior
+                sampler = WarmStart(sampler, top_designs(task, args.warm_start_top_k), args.warm_start_t)
+            sampler_kwargs = dict(sampler_kwargs,
+                                  max_rounds=args.max_resample_rounds,
+                                  clamp=args.clamp_x,
+                                  bound=args.divergence_bound)
+            if args.shard_workers != 0:
+                # forked CPU workers share the drift network, designs are keyed by index so the seed fixes the result
+                sampler_kwargs['seed'] = args.seed if args.noise_seed is None else args.noise_seed
+                if args.shard_workers < 0:
+                    shard_workers, shard_threads = tune_shards(sampler, gen_sde, dim, args.condition, num_steps,
+                                                               **sampler_kwargs)
+                else:
+                    shard_workers, shard_threads = args.shard_workers, args.shard_threads
+                x, stats = sharded_sample(sampler,
+                                          gen_sde,
+                                          num_samples,
+                                          dim,
+                                          args.condition,
+                                          num_steps,
+                                          num_workers=shard_workers,
+                                          num_threads=shard_threads,
+                                          **sampler_kwargs)  # sample
+            else:
+                x, stats = sample_valid(sampler,
+                                        gen_sde,
+                                        num_samples,
+                                        dim,
+                                        args.condition,
+                                        num_steps,
+                                        seed=args.noise_seed,
+                                        **sampler_kwargs)  # sample
+            xs = [x]
+            print("NFE: {nfe} ({sequential_nfe} sequential), failure rate: {failure_rate:.4f}, wasted sample-NFE: "
+                  "{wasted_sample_nfe} of {sample_nfe}".format(**stats))
+
+        print("{:.1f} designs/s".format(num_samples / (time.perf_counter() - start)))
+
+        if args.elbo_keep_frac is not None:
+            # drop the designs the unconditional model finds least likely before they reach the oracle
+            elbo, elbo_var = elbo_scores(gen_sde, xs[-1], num_probes=args.elbo_probes, chunk_size=args.chunk_size)
+            keep = np.sort(np.argsort(-elbo)[:max(1, int(round(args.elbo_keep_frac * len(elbo))))])
+            xs = [x[keep] for x in xs]
+            print("ELBO filter: kept {} of {} designs, probe std {:.4f}, std of the mean {:.4f}".format(
+                len(keep), len(elbo), np.sqrt(elbo_var.mean()), np.sqrt(elbo_var.mean() / args.elbo_probes)))
 
         ctr = 0
         pred_model = _get_trained_model()
@@ -643,8 +753,9 @@ def run_evaluate(
                     ys = task.predict(qqq.cpu().numpy())
                 else:
                     qqq = qqq.view(qqq.size(0), -1, task.x.shape[-1])
-                    ys = task.predict(qqq.cpu().numpy())
+                    ys = oracle(qqq.cpu().numpy())
                     print(ys)
+                    print(oracle.summary())
 
                 pred_ys = pred_model.mlp(qqq)
                 preds.append(pred_ys.cpu().numpy())
@@ -682,6 +793,273 @@ def run_evaluate(
     shutil.copy(args.configs, save_results_dir)
 
 
+@torch.no_grad()
+def run_sweep(
+    taskname,
+    seed,
+    checkpoint_path,
+    args,
+    device=None,
+    normalise_x=False,
+    normalise_y=False,
+):
+    """
+    Sample every (condition, gamma, lamda, sampling seed) combination of the --sweep_* lists with a single
+    checkpoint load and a single sampler run, saving each configuration like a separate eval run.
+    """
+    set_seed(seed)
+    task, dim = load_task(taskname, normalise_x, normalise_y)
+
+    gen_sde, num_steps = load_sampling_model(checkpoint_path, taskname, task, args, device)
+
+    num_samples = args.num_samples
+    conditions = args.sweep_conditions or [task.y.max()]
+    gammas = args.sweep_gammas or [args.gamma]
+    lamdas = args.sweep_lamdas or [args.lamda]
+    sampling_seeds = args.sweep_seeds or [seed]
+    configs = [
+        dict(y=condition, gamma=gamma, lmbd=lamda, seed=sampling_seed)
+        for condition in conditions for gamma in gammas
+        for lamda in lamdas for sampling_seed in sampling_seeds
+    ]
+
+    sampler, sampler_kwargs = get_sampler(args)
+    # guidance weights and lmbds are set per configuration
+    sampler_kwargs.pop('gamma')
+    sampler_kwargs.pop('lmbd', None)
+    designs, nfe = grid_sample(sampler, gen_sde, configs, num_samples, dim, num_steps, **sampler_kwargs)
+    print("Sampled {} configurations, NFE: {}".format(len(configs), nfe))
+
+    expt_save_path = f"./experiments/{args.task}/{args.name}/{args.seed}"
+    assert os.path.exists(expt_save_path)
+    alias = uuid.uuid4()
+    # configurations sharing their noise often decode to the same sequences, which are scored once
+    oracle = OracleCache(task.predict) if task.is_discrete else None
+    for config, x in zip(configs, designs):
+        x = x.numpy()
+        if not task.is_discrete:
+            ys = task.predict(x)
+        else:
+            ys = oracle(x.reshape(x.shape[0], -1, task.x.shape[-1]))
+        if normalise_y:
+            ys = task.denormalize_y(ys)
+        print("condition={y}, gamma={gamma}, lamda={lmbd}, seed={seed}: ".format(**config) +
+              "max {}".format(ys.max()))
+
+        run_specific_str = f"{num_samples}_{num_steps}_{config['y']}_{config['gamma']}_{args.beta_min}_{args.beta_max}_{args.suffix}_sweep_lamda={config['lmbd']}_seed={config['seed']}_{alias}"
+        save_results_dir = os.path.join(
+            expt_save_path, f"wandb/latest-run/files/results/{run_specific_str}/")
+        os.makedirs(save_results_dir, exist_ok=True)
+
+        with open(os.path.join(save_results_dir, 'designs.pkl'), 'wb') as f:
+            pkl.dump(x, f)
+
+        with open(os.path.join(save_results_dir, 'results.pkl'), 'wb') as f:
+            pkl.dump(ys, f)
+
+        if args.configs is not None:
+            shutil.copy(args.configs, save_results_dir)
+    if oracle is not None:
+        print(oracle.summary())
+
+
+@torch.no_grad()
+def run_stacked_eval(
+    taskname,
+    seeds,
+    args,
+    device=None,
+    normalise_x=False,
+    normalise_y=False,
+):
+    """
+    Sample the checkpoints of several training seeds of the same architecture in one sampler loop, their MLPs
+    stacked along a model dimension, and save the designs of each seed like a separate eval run of that seed.
+    """
+    set_seed(seeds[0])
+    task, dim = load_task(taskname, normalise_x, normalise_y)
+
+    gen_sdes = []
+    for seed in seeds:
+        checkpoint_path = os.path.join(f"./experiments/{args.task}/{args.name}/{seed}",
+                                       "wandb/latest-run/files/checkpoints/last.ckpt")
+        gen_sdes.append(load_diffusion_model(checkpoint_path, taskname, task, args, device).gen_sde)
+    gen_sde = stack_gen_sdes(gen_sdes)
+
+    num_samples = args.num_samples
+    num_steps = args.num_steps
+    args.condition = task.y.max()
+    sampler, sampler_kwargs = get_sampler(args, lmbd=args.lamda)
+    start = time.perf_counter()
+    designs, nfe = stacked_sample(sampler,
+                                  gen_sde,
+                                  len(seeds),
+                                  num_samples,
+                                  dim,
+                                  args.condition,
+                                  num_steps,
+                                  seed=args.noise_seed,
+                                  **sampler_kwargs)
+    print("Sampled {} checkpoints, NFE: {}, {:.1f} designs/s".format(
+        len(seeds), nfe, len(seeds) * num_samples / (time.perf_counter() - start)))
+
+    alias = uuid.uuid4()
+    oracle = OracleCache(task.predict) if task.is_discrete else None
+    for seed, x in zip(seeds, designs):
+        x = x[torch.isfinite(x).all(1)].numpy()
+        if not task.is_discrete:
+            ys = task.predict(x)
+        else:
+            ys = oracle(x.reshape(x.shape[0], -1, task.x.shape[-1]))
+        if normalise_y:
+            ys = task.denormalize_y(ys)
+        print("seed={}: {} designs, max {}".format(seed, len(x), ys.max()))
+
+        run_specific_str = f"{num_samples}_{num_steps}_{args.condition}_{args.gamma}_{args.beta_min}_{args.beta_max}_{args.suffix}_stacked_{alias}"
+        save_results_dir = os.path.join(f"./experiments/{args.task}/{args.name}/{seed}",
+                                        f"wandb/latest-run/files/results/{run_specific_str}/")
+        os.makedirs(save_results_dir, exist_ok=True)
+
+        with open(os.path.join(save_results_dir, 'designs.pkl'), 'wb') as f:
+            pkl.dump(x, f)
+
+        with open(os.path.join(save_results_dir, 'results.pkl'), 'wb') as f:
+            pkl.dump(ys, f)
+
+        if args.configs is not None:
+            shutil.copy(args.configs, save_results_dir)
+    if oracle is not None:
+        print(oracle.summary())
+
+
+@torch.no_grad()
+def run_grid_benchmark(
+    taskname,
+    seed,
+    checkpoint_path,
+    args,
+    device=None,
+    normalise_x=False,
+    normalise_y=False,
+):
+    """
+    Best-of-num_samples oracle score against NFE for every time grid in --bench_grids and step count in
+    --bench_num_steps, with the sampler and the sampling seed of the eval mode. Writes grid_benchmark.csv
+    to the experiment directory.
+    """
+    set_seed(seed)
+    task, dim = load_task(taskname, normalise_x, normalise_y)
+
+    model = load_diffusion_model(checkpoint_path, taskname, task, args, device)
+
+    num_samples = args.num_samples
+    args.condition = task.y.max()
+    sampler, sampler_kwargs = get_sampler(args, lmbd=args.lamda)
+
+    # common random numbers: the same prior and noise for every grid
+    noise_seed = seed if args.noise_seed is None else args.noise_seed
+    rows = []
+    oracle = OracleCache(task.predict) if task.is_discrete else None
+    for grid in args.bench_grids:
+        for num_steps in args.bench_num_steps:
+            sampler_kwargs['grid'] = grid
+            x, stats = sample_valid(sampler,
+                                    model.gen_sde,
+                                    num_samples,
+                                    dim,
+                                    args.condition,
+                                    num_steps,
+                                    max_rounds=args.max_resample_rounds,
+                                    clamp=args.clamp_x,
+                                    bound=args.divergence_bound,
+                                    seed=noise_seed,
+                                    **sampler_kwargs)
+            x = x.numpy()
+            if not task.is_discrete:
+                ys = task.predict(x)
+            else:
+                ys = oracle(x.reshape(x.shape[0], -1, task.x.shape[-1]))
+            if normalise_y:
+                ys = task.denormalize_y(ys)
+            rows.append(dict(grid=grid,
+                             num_steps=num_steps,
+                             nfe=stats['nfe'],
+                             best=float(ys.max()),
+                             median=float(np.median(ys)),
+                             failure_rate=stats['failure_rate']))
+            print("{grid:>10} steps={num_steps:<5} NFE={nfe:<5} best={best:.4f} median={median:.4f}".format(**rows[-1]))
+
+    expt_save_path = f"./experiments/{args.task}/{args.name}/{args.seed}"
+    os.makedirs(expt_save_path, exist_ok=True)
+    pd.DataFrame(rows).to_csv(os.path.join(expt_save_path, 'grid_benchmark.csv'), index=False)
+    if oracle is not None:
+        print(oracle.summary())
+
+
+def run_distillation(taskname, seed, checkpoint_path, args, device=None):
+    """
+    Distill the trained DDOM checkpoint into few-step students (progressive distillation) or a consistency
+    model, saved under distilled/ in the experiment directory (see distill.py).
+    """
+    set_seed(seed)
+    task, _ = load_task(taskname, args.normalise_x, args.normalise_y)
+
+    model = load_diffusion_model(checkpoint_path, taskname, task, args, device)
+    for p in model.parameters():
+        p.requires_grad_(False)
+    x = torch.tensor(task.x.reshape(task.x.shape[0], -1), dtype=torch.float32)
+    y = torch.tensor(task.y.reshape(-1, 1), dtype=torch.float32)
+    save_dir = os.path.join(f"./experiments/{taskname}/{args.name}/{args.seed}", "distilled")
+    if args.distill_method == 'consistency':
+        consistency_distillation(model.gen_sde,
+                                 x,
+                                 y,
+                                 os.path.join(save_dir, "consistency.pt"),
+                                 hidden_dim=args.hidden_size,
+                                 num_steps=args.consistency_train_steps,
+                                 num_iters=args.distill_iters,
+                                 batch_size=args.batch_size,
+                                 learning_rate=args.distill_learning_rate,
+                                 gamma_max=args.distill_gamma_max)
+        return
+    progressive_distillation(model.gen_sde,
+                             x,
+                             y,
+                             save_dir,
+                             teacher_steps=args.distill_teacher_steps,
+                             min_steps=args.distill_min_steps,
+                             num_iters=args.distill_iters,
+                             batch_size=args.batch_size,
+                             learning_rate=args.distill_learning_rate,
+                             gamma_max=args.distill_gamma_max)
+
+
+def run_serve(args, device=None):
+    """
+    Load the checkpoint of every task in --serve_tasks (default --task) once and serve designs over HTTP,
+    see serve.py.
+    """
+    models = {}
+    for taskname in args.serve_tasks or [args.task]:
+        task, _ = load_task(taskname, args.normalise_x, args.normalise_y)
+        checkpoint_path = os.path.join(f"./experiments/{taskname}/{args.name}/{args.seed}",
+                                       "wandb/latest-run/files/checkpoints/last.ckpt")
+        gen_sde, num_steps = load_sampling_model(checkpoint_path, taskname, task, args, device)
+        models[taskname] = dict(gen_sde=gen_sde, shape=tuple(task.x.shape[1:]), condition=float(task.y.max()))
+
+    sampler, sampler_kwargs = get_sampler(args, lmbd=args.lamda)
+    # guidance weights are set per request
+    sampler_kwargs.pop('gamma')
+    server = DesignServer(models,
+                          sampler,
+                          sampler_kwargs,
+                          num_steps,
+                          max_batch=args.max_batch,
+                          max_wait=args.max_wait_ms / 1000.,
+                          default_gamma=args.gamma)
+    server.serve_forever(args.host, args.port)
+
+
 if __name__ == "__main__":
     parser = configargparse.ArgumentParser()
     # configuration
@@ -693,7 +1071,7 @@ if __name__ == "__main__":
         help="path(s) to configuration file(s)",
     )
     parser.add_argument('--mode',
-                        choices=['train', 'eval'],
+                        choices=['train', 'eval', 'sweep', 'stacked_eval', 'grid_benchmark', 'serve', 'distill'],
                         default='train',
                         required=True)
     parser.add_argument('--task',
@@ -800,6 +1178,233 @@ if __name__ == "__main__":
                         type=int,
                         default=1000,
                         help='number of integration steps for sampling')
+    parser.add_argument('--sampler',
+                        type=str,
+                        choices=['heun', 'euler_maruyama', 'pc', 'ode', 'dpm_solver', 'ddim', 'picard', 'distilled', 'consistency'],
+                        default='heun',
+                        help='sampler used to integrate the reverse process')
+    parser.add_argument('--ode_rtol',
+                        type=float,
+                        default=1e-3,
+                        help='relative tolerance of the adaptive probability flow ODE sampler')
+    parser.add_argument('--ode_atol',
+                        type=float,
+                        default=1e-3,
+                        help='absolute tolerance of the adaptive probability flow ODE sampler')
+    parser.add_argument('--solver_order',
+                        type=int,
+                        choices=[1, 2, 3],
+                        default=2,
+                        help='order of the multistep DPM-Solver sampler')
+    parser.add_argument('--eta',
+                        type=float,
+                        default=0.,
+                        help='stochasticity of the DDIM sampler (0 is deterministic)')
+    parser.add_argument('--predictor',
+                        type=str,
+                        choices=['euler', 'heun'],
+                        default='heun',
+                        help='predictor of the predictor-corrector sampler')
+    parser.add_argument('--n_corrector',
+                        type=int,
+                        default=1,
+                        help='Langevin corrector steps per step of the predictor-corrector sampler')
+    parser.add_argument('--snr',
+                        type=float,
+                        default=0.16,
+                        help='signal-to-noise ratio that sizes the Langevin corrector steps')
+    parser.add_argument(
+        '--fsal',
+        type=eval,
+        choices=[True, False],
+        default=True,
+        help='reuse the drift at the Heun predictor as the drift at the start of the next step')
+    parser.add_argument('--separable_first_layer',
+                        action='store_true',
+                        default=False,
+                        help='split the first layer of the MLP when sampling with guidance, so that its input part '
+                        'is shared by the conditional and unconditional branches')
+    parser.add_argument('--picard_window',
+                        type=int,
+                        default=16,
+                        help='steps solved together by Picard iteration with --sampler picard')
+    parser.add_argument('--picard_tol',
+                        type=float,
+                        default=1e-3,
+                        help='root mean square change per dimension below which a Picard step is accepted')
+    parser.add_argument('--compile_backend',
+                        type=str,
+                        choices=['none', 'auto', 'jit', 'compile'],
+                        default='none',
+                        help='compile one full step of the euler_maruyama / heun samplers and reuse it for all steps')
+    parser.add_argument('--time_grid',
+                        type=str,
+                        choices=['uniform', 'quadratic', 'edm', 'logsnr'],
+                        default=None,
+                        help='time discretisation of the fixed grid samplers (default: the sampler\'s own)')
+    parser.add_argument('--t_stop',
+                        type=float,
+                        default=None,
+                        help='stop the fixed grid samplers at this forward time instead of the sampler\'s default')
+    parser.add_argument('--denoise',
+                        action='store_true',
+                        default=False,
+                        help='replace the state reached at --t_stop, which must be > 0, by its Tweedie posterior '
+                        'mean (one extra NFE)')
+    parser.add_argument('--noise_seed',
+                        type=int,
+                        default=None,
+                        help='draw the prior and the sampler noise of design n from a counter-based stream keyed by '
+                        '(noise_seed, n), independent of batch size and chunking (default: global RNG)')
+    parser.add_argument('--warm_start_t',
+                        type=float,
+                        default=None,
+                        help='start the fixed grid samplers in eval from the top dataset designs diffused to this '
+                        'forward time instead of from the prior at T; the steps shrink in proportion (default: off)')
+    parser.add_argument('--warm_start_top_k',
+                        type=int,
+                        default=128,
+                        help='number of top dataset designs the warm start draws from')
+    parser.add_argument('--surrogate_scale',
+                        type=float,
+                        default=0.,
+                        help='in eval, guide the sampler with the gradient of the trained forward model at the '
+                        'denoised design, scaled by this times mean_weight(t) (default: 0, off)')
+    parser.add_argument('--shard_workers',
+                        type=int,
+                        default=0,
+                        help='sample on CPU in this many forked worker processes sharing the drift network, '
+                        '-1 to pick workers and threads by a short probe (default: 0, in process)')
+    parser.add_argument('--shard_threads',
+                        type=int,
+                        default=None,
+                        help='intra-op threads per sampling worker (default: the cores split between the workers)')
+    parser.add_argument('--distill_method', type=str, choices=['progressive', 'consistency'], default='progressive')
+    parser.add_argument('--distill_teacher_steps',
+                        type=int,
+                        default=1024,
+                        help='DDIM steps of the DDOM teacher in the first progressive distillation round')
+    parser.add_argument('--distill_min_steps',
+                        type=int,
+                        default=8,
+                        help='halve the number of steps until it would drop below this')
+    parser.add_argument('--distill_iters',
+                        type=int,
+                        default=5000,
+                        help='training iterations per progressive distillation round, or of consistency distillation')
+    parser.add_argument('--distill_learning_rate', type=float, default=1e-4)
+    parser.add_argument('--distill_gamma_max',
+                        type=float,
+                        default=None,
+                        help='students are trained for guidance weights in [0, distill_gamma_max] (default: --gamma)')
+    parser.add_argument('--student_steps',
+                        type=int,
+                        default=8,
+                        help='distilled/student_<steps>.pt is sampled with --sampler distilled')
+    parser.add_argument('--consistency_train_steps',
+                        type=int,
+                        default=40,
+                        help='discretisation of the teacher ODE in consistency distillation')
+    parser.add_argument('--consistency_sample_steps',
+                        type=int,
+                        default=1,
+                        help='network evaluations per design with --sampler consistency')
+    parser.add_argument('--serve_tasks',
+                        type=str,
+                        nargs='+',
+                        choices=list(TASKNAME2TASK.keys()),
+                        default=None,
+                        help='tasks served in serve mode, each loaded from its --name/--seed checkpoint '
+                        '(default: --task)')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch',
+                        type=int,
+                        default=1024,
+                        help='largest sampler batch of coalesced requests in serve mode')
+    parser.add_argument('--max_wait_ms',
+                        type=float,
+                        default=10.,
+                        help='how long serve mode waits for more requests before sampling a batch')
+    parser.add_argument('--bench_grids',
+                        type=str,
+                        nargs='+',
+                        choices=['uniform', 'quadratic', 'edm', 'logsnr'],
+                        default=['uniform', 'quadratic', 'edm', 'logsnr'],
+                        help='time grids compared in grid_benchmark mode')
+    parser.add_argument('--bench_num_steps',
+                        type=int,
+                        nargs='+',
+                        default=[10, 25, 50, 100, 250, 1000],
+                        help='step counts compared in grid_benchmark mode')
+    parser.add_argument('--max_resample_rounds',
+                        type=int,
+                        default=5,
+                        help='how many times failed (non-finite) samples are resampled')
+    parser.add_argument('--clamp_x',
+                        type=float,
+                        default=None,
+                        help='clamp the sampler state to [-clamp_x, clamp_x] after every step')
+    parser.add_argument('--divergence_bound',
+                        type=float,
+                        default=None,
+                        help='mark a trajectory as failed once any coordinate exceeds this magnitude')
+    parser.add_argument('--stream_samples',
+                        type=int,
+                        default=0,
+                        help='if > 0, stream this many samples to a memory mapped trajectories.npy instead of evaluating')
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=512,
+                        help='number of samples integrated together when streaming')
+    parser.add_argument('--elbo_probes',
+                        type=int,
+                        default=8,
+                        help='(t, noise, Hutchinson) draws averaged per design in the ELBO pre-filter')
+    parser.add_argument('--elbo_keep_frac',
+                        type=float,
+                        default=None,
+                        help='in eval, only score the designs in this top fraction by the unconditional ELBO; '
+                        'streamed pools save elbo.npy, elbo_var.npy and the kept indices elbo_keep.npy (default: off)')
+    parser.add_argument('--snapshot_stride',
+                        type=int,
+                        default=None,
+                        help='write the state every this many steps when streaming (default: final designs only)')
+    parser.add_argument('--snapshot_steps',
+                        type=int,
+                        nargs='+',
+                        default=None,
+                        help='explicit list of steps whose state is written when streaming')
+    parser.add_argument('--num_samples',
+                        type=int,
+                        default=512,
+                        help='number of designs sampled per evaluation (per configuration in sweep mode)')
+    parser.add_argument('--sweep_conditions',
+                        type=float,
+                        nargs='+',
+                        default=None,
+                        help='conditions sampled in sweep mode (default: the dataset max)')
+    parser.add_argument('--sweep_gammas',
+                        type=float,
+                        nargs='+',
+                        default=None,
+                        help='guidance weights sampled in sweep mode (default: --gamma)')
+    parser.add_argument('--sweep_lamdas',
+                        type=float,
+                        nargs='+',
+                        default=None,
+                        help='lamdas sampled in sweep mode (default: --lamda)')
+    parser.add_argument('--sweep_seeds',
+                        type=int,
+                        nargs='+',
+                        default=None,
+                        help='sampling seeds in sweep mode (default: --seed)')
+    parser.add_argument('--stack_seeds',
+                        type=int,
+                        nargs='+',
+                        default=None,
+                        help='training seeds whose checkpoints are sampled together in stacked_eval mode '
+                        '(default: --seed)')
 
     # optimization
     parser.add_argument('--T0',
@@ -879,6 +1484,11 @@ if __name__ == "__main__":
         default=20.0,
     )
     args = parser.parse_args()
+    if args.sampler in DISTILLED_SAMPLERS and (args.time_grid is not None or args.t_stop is not None or args.denoise):
+        parser.error(f"--time_grid, --t_stop and --denoise do not apply to --sampler {args.sampler}")
+    if args.denoise and not (args.t_stop or 0.) > 0.:
+        # at t_stop = 0 the Tweedie jump costs one NFE and barely moves the designs
+        parser.error("--denoise needs --t_stop > 0")
 
     wandb_project = "score-matching " if args.score_matching else "sde-flow"
 
@@ -918,5 +1528,44 @@ if __name__ == "__main__":
                      device=device,
                      normalise_x=args.normalise_x,
                      normalise_y=args.normalise_y)
+    elif args.mode == 'sweep':
+        checkpoint_path = os.path.join(
+            expt_save_path, "wandb/latest-run/files/checkpoints/last.ckpt")
+        run_sweep(taskname=args.task,
+                  seed=args.seed,
+                  checkpoint_path=checkpoint_path,
+                  args=args,
+                  device=device,
+                  normalise_x=args.normalise_x,
+                  normalise_y=args.normalise_y)
+    elif args.mode == 'stacked_eval':
+        run_stacked_eval(taskname=args.task,
+                         seeds=args.stack_seeds or [args.seed],
+                         args=args,
+                         device=device,
+                         normalise_x=args.normalise_x,
+                         normalise_y=args.normalise_y)
+    elif args.mode == 'distill':
+        checkpoint_path = os.path.join(
+            expt_save_path, "wandb/latest-run/files/checkpoints/last.ckpt")
+        if args.distill_gamma_max is None:
+            args.distill_gamma_max = args.gamma
+        run_distillation(taskname=args.task,
+                         seed=args.seed,
+                         checkpoint_path=checkpoint_path,
+                         args=args,
+                         device=device)
+    elif args.mode == 'serve':
+        run_serve(args, device=device)
+    elif args.mode == 'grid_benchmark':
+        checkpoint_path = os.path.join(
+            expt_save_path, "wandb/latest-run/files/checkpoints/last.ckpt")
+        run_grid_benchmark(taskname=args.task,
+                           seed=args.seed,
+                           checkpoint_path=checkpoint_path,
+                           args=args,
+                           device=device,
+                           normalise_x=args.normalise_x,
+                           normalise_y=args.normalise_y)
     else:
         raise NotImplementedError
@@ -154,3 +154,71 @@ def get_weights(scores, base_temp=None, temp=None):
     weights = provable_dist[np.minimum(bin_indices, 19)] / (hist_prob + 1e-7)
     weights = np.clip(weights, a_min=0.0, a_max=5.0)
     return weights.astype(np.float32)[:, np.newaxis]
+
+
+## ORACLE SCORING
+def decode_logits(logits):
+    """Decode design-bench logits of shape (N, L, C-1) into integer
+    sequences of shape (N, L), with a vectorised argmax over the logits
+    padded with the zero logit of class 0
+
+    Args:
+
+    logits: np.ndarray
+        logits relative to class 0, as produced by task.map_to_logits
+
+    Returns:
+
+    integers: np.ndarray
+        the class of every position of every design
+    """
+
+    padded = np.pad(logits, [(0, 0)] * (logits.ndim - 1) + [(1, 0)])
+    return padded.argmax(axis=-1)
+
+
+class OracleCache:
+    """Score discrete designs with an expensive oracle, sending only the
+    unique decoded sequences that were not scored before and scattering
+    the scores back to the full batch
+
+    Args:
+
+    predict: Callable
+        the oracle, e.g. task.predict, called on logits of shape
+        (M, L, C-1); any logits of a sequence give the same score
+    """
+
+    def __init__(self, predict):
+        self.predict = predict
+        self.scores = {}
+        self.num_designs = 0
+        self.num_unique = 0
+        self.num_scored = 0
+        self.num_calls = 0
+
+    def __call__(self, logits):
+        integers = decode_logits(logits)
+        unique, first, inverse = np.unique(integers.reshape(len(integers), -1),
+                                           axis=0,
+                                           return_index=True,
+                                           return_inverse=True)
+        keys = [row.tobytes() for row in unique]
+        new = [k for k, key in enumerate(keys) if key not in self.scores]
+        if new:
+            scores = self.predict(logits[first[new]])
+            self.num_scored += len(new)
+            self.num_calls += 1
+            for k, score in zip(new, scores):
+                self.scores[keys[k]] = score
+        self.num_designs += len(integers)
+        self.num_unique += len(unique)
+        return np.stack([self.scores[key] for key in keys])[inverse.reshape(-1)]
+
+    def summary(self):
+        """Designs scored so far, unique designs among them and oracle
+        evaluations actually spent."""
+        return ("oracle: {} designs, {} unique within their batch, {} evaluated in {} calls "
+                "({:.2f} designs per oracle evaluation)".format(
+                    self.num_designs, self.num_unique, self.num_scored, self.num_calls,
+                    self.num_designs / max(self.num_scored, 1)))
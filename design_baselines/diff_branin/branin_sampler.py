@@ -1,6 +1,6 @@
 import numpy as np 
 import random 
-from trainer import Branin
+from branin_task import Branin
 
 np.random.seed(42)
 mean = np.array([3.141592, 2.275])
@@ -0,0 +1,54 @@
+"""
+The Branin stand-in task, kept free of Lightning and design-bench imports so that diff/bench_samplers.py can load it
+next to trainer.py.
+"""
+
+import pickle
+
+import numpy as np
+
+from bayeso_benchmarks.two_dim_branin import Branin as BraninFunction
+
+
+class Branin:
+
+    def __init__(self, path="design_baselines/diff_branin/dataset/branin_gaussian_5k.p"):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        self.x = data[0].astype(np.float32)
+        self.y = data[1].astype(np.float32)
+
+        self.mean_x = self.x.mean(axis=0)
+        self.std_x = self.x.std(axis=0)
+
+        self.mean_y = self.y.mean(axis=0)
+        self.std_y = self.y.std(axis=0)
+
+        self.is_x_normalized = False
+        self.is_y_normalized = False
+
+        self.is_discrete = False
+        self.obj_func = BraninFunction()
+
+    def map_normalize_x(self):
+        self.x = (self.x - self.mean_x) / self.std_x
+        self.is_x_normalized = True
+
+    def map_normalize_y(self):
+        self.y = (self.y - self.mean_y) / self.std_y
+        self.is_y_normalized = True
+
+    def predict(self, x):
+
+        if self.is_x_normalized:
+            x = x * self.std_x + self.mean_x
+
+        # clip a copy, the designs of the caller are left untouched
+        x = x.copy()
+        x[:, 0] = np.clip(x[:, 0], self.obj_func.bounds[0, 0], self.obj_func.bounds[0, 1])
+        x[:, 1] = np.clip(x[:, 1], self.obj_func.bounds[1, 0], self.obj_func.bounds[1, 1])
+
+        return 2*(-self.obj_func.output(x))+2
+
+    def denormalize_y(self, y):
+        return y * self.std_y + self.mean_y
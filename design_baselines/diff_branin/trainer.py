@@ -14,8 +14,6 @@ import configargparse
 import sys
 from contextlib import contextmanager, redirect_stderr, redirect_stdout
 
-from bayeso_benchmarks.two_dim_branin import Branin as BraninFunction
-
 import matplotlib.pyplot as plt
 
 from forward import ForwardModel
@@ -27,53 +25,13 @@ import pickle as pkl
 import torch
 from torch.utils.data import Dataset, DataLoader
 
+from branin_task import Branin
 from nets import DiffusionTest, DiffusionScore
 from util import TASKNAME2TASK, configure_gpu, set_seed, get_weights
 
 args_filename = "args.json"
 checkpoint_dir = "checkpoints"
 
-class Branin:
-
-    def __init__(self, path="design_baselines/diff_branin/dataset/branin_gaussian_5k.p"):
-        data = pickle.load(open(path, "rb"))
-        self.x = data[0].astype(np.float32)
-        self.y = data[1].astype(np.float32)
-
-        self.mean_x = self.x.mean(axis=0)
-        self.std_x = self.x.std(axis=0)
-
-        self.mean_y = self.y.mean(axis=0)
-        self.std_y = self.y.std(axis=0)
-
-        self.is_x_normalized = False
-        self.is_y_normalized = False
-
-        self.is_discrete = False
-        self.obj_func = BraninFunction()
-
-
-    def map_normalize_x(self):
-        self.x = (self.x - self.mean_x) / self.std_x
-        self.is_x_normalized = True
-
-    def map_normalize_y(self):
-        self.y = (self.y - self.mean_y) / self.std_y
-        self.is_y_normalized = True
-
-    def predict(self, x):
-
-        if self.is_x_normalized:
-            x = x * self.std_x + self.mean_x
-
-        x[:, 0] = np.clip(x[:, 0], self.obj_func.bounds[0, 0], self.obj_func.bounds[0, 1])
-        x[:, 1] = np.clip(x[:, 1], self.obj_func.bounds[1, 0], self.obj_func.bounds[1, 1])
-
-        return 2*(-self.obj_func.output(x))+2
-
-    def denormalize_y(self, y):
-        return y * self.std_y + self.mean_y
-
 class RvSDataset(Dataset):
 
     def __init__(self, task, x, y, w=None, device=None, mode='train'):
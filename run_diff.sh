@@ -11,3 +11,6 @@ for seed in $seeds; do
   # python design_baselines/diff/trainer.py --config $CONFIG --seed $seed --use_gpu --mode 'train' --task $TASK
   python design_baselines/diff/trainer.py --config $CONFIG --seed $seed --use_gpu --mode 'eval' --task $TASK --suffix "max_ds_conditioning"
 done
+
+# or sample the checkpoints of all seeds together in one process:
+# python design_baselines/diff/trainer.py --config $CONFIG --seed 123 --use_gpu --mode 'stacked_eval' --stack_seeds $seeds --task $TASK --suffix "max_ds_conditioning"